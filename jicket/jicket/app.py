@@ -4,19 +4,29 @@ Main Jicket application
 
 import argparse
 from pathlib import Path
+import imaplib
 import os
 import time
 
 import jicket.log as log
 import jicket.mailhandling as mailhandling
 import jicket.jiraintegration as jiraintegration
+import jicket.ledger as ledger
+import jicket.metrics as metrics
 from jicket.mailfilter import MailFilter
 
-from typing import List, Tuple
+from typing import List, Tuple, Iterable, Dict, Set
 
 from jicket.mailhandling import MailImporter, MailExporter
 from jicket.config import MailConfig, JiraConfig
 from jicket.mailprocessor import ProcessedMail
+from jicket.jiraintegration import JiraSession
+from jicket.issueindex import IssueIndex
+from jicket.pipeline import TicketPipeline
+from jicket.workqueue import WorkQueue
+from jicket.ledger import Ledger
+from jicket.routing import Route
+import jicket.routing as routing
 
 
 class LoopHandler():
@@ -49,20 +59,45 @@ class IntervalLoop(LoopHandler):
             return False
 
 
+class IdleLoop(LoopHandler):
+    """Waits for new mail with IMAP IDLE, falling back to dynamic polling if the server doesn't support it"""
+    def __init__(self, looptime: int, importer: MailImporter, idletime: int = 1500):
+        super().__init__(looptime)
+        self.importer = importer  # type: MailImporter
+        self.idletime = idletime  # type: int   # Time after which IDLE is re-issued
+
+        if not self.importer.supports_idle():
+            log.warning("IMAP server does not support IDLE, falling back to polling every %is", self.looptime)
+
+    def tick(self) -> bool:
+        if self.firstExecution:  # Process mails that arrived before startup
+            self.firstExecution = False
+            return True
+        if not self.importer.supports_idle():
+            time.sleep(self.looptime)
+            return True
+
+        # Also run when IDLE merely timed out, as a safety net for announcements that were missed
+        if self.importer.idle(self.idletime):
+            log.info("IMAP server announced new mail")
+        return True
+
+
 class Singleshot(LoopHandler):
     def tick(self) -> bool:
         self.continuerunning = False
         return True
 
 
-def argparse_env(varname, default=None):
+def argparse_env(varname, default=None, required=True):
     """Helper function for fetching environment variables in argparse
 
     This function fetches an environment variable, which is returned as the default value for the argument. If no
-    environment variable is found, and no default value is set, the argument is instead set to required.
+    environment variable is found, and no default value is set, the argument is instead set to required, unless
+    required is False.
 
     Usage: parser.add_argument("--foo", **argparse_env(varname, default))"""
-    if os.getenv(varname, default) is not None:
+    if os.getenv(varname, default) is not None or not required:
         return {"default": os.getenv(varname, default), "metavar": varname}
     else:
         return {"required": True, "metavar": varname}
@@ -73,38 +108,72 @@ class JicketApp():
         self.args: argparse.Namespace = None
 
         self.parse_arguments()
-        self.populate_config()
 
-        self.importer: MailImporter = MailImporter(self.mailconf)
-        self.exporter: MailExporter = MailExporter(self.mailconf)
+        self.queued: bool = self.args.pipeline == "queued"
+        if self.queued and not self.args.statedb:
+            raise Exception("The queued pipeline requires a state database (--statedb)")
+
+        self.issueindex: IssueIndex = None
+        self.ledger: Ledger = None
+        if self.args.statedb:
+            self.issueindex = IssueIndex(Path(self.args.statedb))
+            self.ledger = Ledger(Path(self.args.statedb), self.args.ledgerretention * 24 * 3600)
+
+        self.routes: List[Route] = self.create_routes()
+        self.routesbyname: Dict[str, Route] = {route.name: route for route in self.routes}
 
-        self.mailfilter: MailFilter = None
-        if self.args.filterconfig:
-            filterconfigpath = Path(self.args.filterconfig)
-            self.mailfilter = MailFilter(filterconfigpath)
+        self.pipeline: TicketPipeline = None
+        if self.args.workers > 1:
+            handler = self.consume_mail if self.queued else self.process_mail
+            self.pipeline = TicketPipeline(self.args.workers, handler)
+
+        if self.args.metricsport:
+            metrics.serve(self.args.metricsport, self.args.metricshost)
+        self.metricssummary = metrics.SummaryLogger(self.args.metricsinterval)
 
         log.success("Initialization successful")
 
     def parse_arguments(self):
+        # With routes, options required for a mailbox may be given per route instead
+        preparser = argparse.ArgumentParser(add_help=False)
+        preparser.add_argument("--routes", type=str, **argparse_env("JICKET_ROUTES", ""))
+        routed = bool(preparser.parse_known_args()[0].routes)
+
         parser = argparse.ArgumentParser("Jicket - Jira Email Ticket System")
 
-        parser.add_argument("--imaphost", type=str, help="Host URL of IMAP mailbox", **argparse_env("JICKET_IMAP_HOST"))
+        parser.add_argument("--routes", type=str,
+                            help="Path to file containing routes of multiple mailboxes into Jira projects, if any",
+                            **argparse_env("JICKET_ROUTES", ""))
+
+        parser.add_argument("--imaphost", type=str, help="Host URL of IMAP mailbox",
+                            **argparse_env("JICKET_IMAP_HOST", required=not routed))
         parser.add_argument("--imapport", type=int, help="Port of IMAP host", **argparse_env("JICKET_IMAP_PORT", 993))
-        parser.add_argument("--imapuser", type=str, help="User for IMAP", **argparse_env("JICKET_IMAP_USER"))
-        parser.add_argument("--imappass", type=str, help="Password for IMAP", **argparse_env("JICKET_IMAP_PASS"))
+        parser.add_argument("--imapuser", type=str, help="User for IMAP",
+                            **argparse_env("JICKET_IMAP_USER", required=not routed))
+        parser.add_argument("--imappass", type=str, help="Password for IMAP",
+                            **argparse_env("JICKET_IMAP_PASS", required=not routed))
 
-        parser.add_argument("--smtphost", type=str, help="Host URL of SMTP server", **argparse_env("JICKET_SMTP_HOST"))
+        parser.add_argument("--smtphost", type=str, help="Host URL of SMTP server",
+                            **argparse_env("JICKET_SMTP_HOST", required=not routed))
         parser.add_argument("--smtpport", type=int, help="Port of SMTP host", **argparse_env("JICKET_SMTP_PORT", 587))
         parser.add_argument("--smtpuser", type=str, help="User for SMTP (If left empty, IMAP user is used)",
                             **argparse_env("JICKET_SMTP_USER", ""))
         parser.add_argument("--smtppass", type=str, help="Password for SMTP (If left empty, IMAP pass is used)",
                             **argparse_env("JICKET_SMTP_PASS", ""))
-
-        parser.add_argument("--jiraurl", type=str, help="URL of JIRA instance", **argparse_env("JICKET_JIRA_URL"))
-        parser.add_argument("--jirauser", type=str, help="User for JIRA instance", **argparse_env("JICKET_JIRA_USER"))
-        parser.add_argument("--jirapass", type=str, help="Password for JIRA user", **argparse_env("JICKET_JIRA_PASS"))
+        parser.add_argument("--smtpidletime", type=int,
+                            help="Time in seconds after which an idle SMTP connection is not reused anymore",
+                            **argparse_env("JICKET_SMTP_IDLETIME", 300))
+
+        parser.add_argument("--jiraurl", type=str, help="URL of JIRA instance",
+                            **argparse_env("JICKET_JIRA_URL", required=not routed))
+        parser.add_argument("--jirauser", type=str, help="User for JIRA instance",
+                            **argparse_env("JICKET_JIRA_USER", required=not routed))
+        parser.add_argument("--jirapass", type=str, help="Password for JIRA user",
+                            **argparse_env("JICKET_JIRA_PASS", ""))
+        parser.add_argument("--jiratoken", type=str, help="Personal access token for JIRA, used instead of password",
+                            **argparse_env("JICKET_JIRA_TOKEN", ""))
         parser.add_argument("--jiraproject", type=str, help="Project to which tickets shall be added",
-                            **argparse_env("JICKET_JIRA_PROJECT"))
+                            **argparse_env("JICKET_JIRA_PROJECT", required=not routed))
 
         parser.add_argument("--folderinbox", type=str, help="Folder from which to read incoming mails",
                             **argparse_env("JICKET_FOLDER_INBOX", "INBOX"))
@@ -113,13 +182,25 @@ class JicketApp():
                             **argparse_env("JICKET_FOLDER_SUCCESS", "jicket"))
         parser.add_argument("--threadtemplate", type=str,
                             help="Folder in which successfully imported mails are put",
-                            **argparse_env("JICKET_THREAD_TEMPLATE"))
+                            **argparse_env("JICKET_THREAD_TEMPLATE", required=not routed))
 
         parser.add_argument("--ticketaddress", type=str, help="Email-address of Helpdesk",
-                            **argparse_env("JICKET_TICKET_ADDRESS"))
+                            **argparse_env("JICKET_TICKET_ADDRESS", required=not routed))
+        parser.add_argument("--maxbodylength", type=int,
+                            help="Maximum number of characters imported from an email body, 0 for unlimited",
+                            **argparse_env("JICKET_MAX_BODY_LENGTH", 32000))
+        parser.add_argument("--maxattachmentsize", type=int,
+                            help="Maximum size of attachments added to issues in bytes, 0 to skip all attachments",
+                            **argparse_env("JICKET_MAX_ATTACHMENT_SIZE", 10 * 1024 * 1024))
         parser.add_argument("--filterconfig", type=str,
                             help="Path to file containing filter config, if any",
                             **argparse_env("JICKET_FILTER_CONFIG", ""))
+        parser.add_argument("--statedb", type=str,
+                            help="Path to SQLite database for local state like the issue index, if any",
+                            **argparse_env("JICKET_STATE_DB", ""))
+        parser.add_argument("--ledgerretention", type=int,
+                            help="Days for which processed mails are remembered in the state database",
+                            **argparse_env("JICKET_LEDGER_RETENTION", 30))
 
         parser.add_argument("--idprefix", type=str, help="Prefix for ticket IDs",
                             **argparse_env("JICKET_ID_PREFIX", "JI-"))
@@ -130,116 +211,448 @@ class JicketApp():
         parser.add_argument("--idminlen", type=int, help="Minimum character length of ID hash",
                             **argparse_env("JICKET_ID_MINLEN", 6))
 
-        parser.add_argument("--loopmode", type=str, help="Loop Mode", choices=["dynamic", "interval", "singleshot"],
+        parser.add_argument("--loopmode", type=str, help="Loop Mode",
+                            choices=["dynamic", "interval", "idle", "singleshot"],
                             **argparse_env("JICKET_LOOPMODE", "dynamic"))
         parser.add_argument("--looptime", type=int, help="Time between imap reads in seconds",
                             **argparse_env("JICKET_LOOPTIME", 60))
+        parser.add_argument("--fetchbatch", type=int, help="Number of mails fetched with a single IMAP command",
+                            **argparse_env("JICKET_FETCH_BATCH", 50))
+        parser.add_argument("--pipeline", type=str,
+                            help="Import mails directly, or through a durable work queue in the state database",
+                            choices=["direct", "queued"], **argparse_env("JICKET_PIPELINE", "direct"))
+        parser.add_argument("--workers", type=int,
+                            help="Number of mails imported into Jira concurrently (mails of a ticket stay in order)",
+                            **argparse_env("JICKET_WORKERS", 1))
+        parser.add_argument("--idletime", type=int, help="Time after which IMAP IDLE is re-issued in seconds",
+                            **argparse_env("JICKET_IDLETIME", 1500))
+        parser.add_argument("--routebatch", type=int,
+                            help="Number of mails imported from a route before the next route takes its turn, "
+                                 "0 for unlimited",
+                            **argparse_env("JICKET_ROUTE_BATCH", 100))
+
+        parser.add_argument("--metricsport", type=int,
+                            help="Port on which metrics are served at /metrics, 0 to disable",
+                            **argparse_env("JICKET_METRICS_PORT", 0))
+        parser.add_argument("--metricshost", type=str, help="Address on which metrics are served",
+                            **argparse_env("JICKET_METRICS_HOST", "127.0.0.1"))
+        parser.add_argument("--metricsinterval", type=int,
+                            help="Time in seconds between summaries of the metrics in the log, 0 to disable",
+                            **argparse_env("JICKET_METRICS_INTERVAL", 300))
+
+        parser.add_argument("--loglevel", type=str, help="Lowest level of messages that are logged",
+                            choices=list(log.LEVELS), **argparse_env("JICKET_LOG_LEVEL", "info"))
+        parser.add_argument("--logformat", type=str, help="Format of the log, text for humans or json lines",
+                            choices=list(log.FORMATS), **argparse_env("JICKET_LOG_FORMAT", "text"))
 
         self.args = parser.parse_args()
-
-    def populate_config(self):
-        self.mailconf: MailConfig = mailhandling.MailConfig()
-        self.jiraconf: JiraConfig = jiraintegration.JiraConfig()
-
-        self.mailconf.IMAPHost = self.args.imaphost
-        self.mailconf.IMAPPort = self.args.imapport
-        self.mailconf.IMAPUser = self.args.imapuser
-        self.mailconf.IMAPPass = self.args.imappass
-
-        self.mailconf.SMTPHost = self.args.smtphost
-        self.mailconf.SMTPPort = self.args.smtpport
-        self.mailconf.SMTPUser = self.args.smtpuser
-        self.mailconf.SMTPPass = self.args.smtppass
-        if self.mailconf.SMTPUser == "":
-            self.mailconf.SMTPUser = self.mailconf.IMAPUser
-        if self.mailconf.SMTPPass == "":
-            self.mailconf.SMTPPass = self.mailconf.IMAPPass
-
-        self.jiraconf.jiraHost = self.args.jiraurl
-        self.jiraconf.jiraUser = self.args.jirauser
-        self.jiraconf.jiraPass = self.args.jirapass
-        self.jiraconf.project = self.args.jiraproject
-
-        self.mailconf.folderInbox = self.args.folderinbox
-        self.mailconf.folderSuccess = self.args.foldersuccess
-        self.mailconf.threadStartTemplate = Path(self.args.threadtemplate)
-
-        self.mailconf.ticketAddress = self.args.ticketaddress
-
-        self.mailconf.idPrefix = self.args.idprefix
-        self.mailconf.idSalt = self.args.idsalt
-        self.mailconf.idAlphabet = self.args.idalphabet
-        self.mailconf.idMinLength = self.args.idminlen
-
-        if self.mailconf.checkValidity():
+        log.configure(self.args.loglevel, self.args.logformat)
+
+    def populate_config(self, args: argparse.Namespace) -> Tuple[MailConfig, JiraConfig]:
+        """Create email and Jira configuration from arguments"""
+        mailconf: MailConfig = mailhandling.MailConfig()
+        jiraconf: JiraConfig = jiraintegration.JiraConfig()
+
+        mailconf.IMAPHost = args.imaphost
+        mailconf.IMAPPort = args.imapport
+        mailconf.IMAPUser = args.imapuser
+        mailconf.IMAPPass = args.imappass
+
+        mailconf.SMTPHost = args.smtphost
+        mailconf.SMTPPort = args.smtpport
+        mailconf.SMTPUser = args.smtpuser
+        mailconf.SMTPPass = args.smtppass
+        if mailconf.SMTPUser == "":
+            mailconf.SMTPUser = mailconf.IMAPUser
+        if mailconf.SMTPPass == "":
+            mailconf.SMTPPass = mailconf.IMAPPass
+        mailconf.SMTPIdleTimeout = args.smtpidletime
+
+        jiraconf.jiraHost = args.jiraurl
+        jiraconf.jiraUser = args.jirauser
+        jiraconf.jiraPass = args.jirapass
+        jiraconf.jiraToken = args.jiratoken
+        jiraconf.project = args.jiraproject
+
+        mailconf.folderInbox = args.folderinbox
+        mailconf.folderSuccess = args.foldersuccess
+        mailconf.threadStartTemplate = Path(args.threadtemplate)
+
+        mailconf.ticketAddress = args.ticketaddress
+        mailconf.fetchBatchSize = args.fetchbatch
+        mailconf.maxBodyLength = args.maxbodylength
+        mailconf.maxAttachmentSize = args.maxattachmentsize
+
+        mailconf.idPrefix = args.idprefix
+        mailconf.idSalt = args.idsalt
+        mailconf.idAlphabet = args.idalphabet
+        mailconf.idMinLength = args.idminlen
+
+        if mailconf.checkValidity():
             log.success("Email configuration valid")
+        if jiraconf.checkValidity():
+            log.success("Jira configuration valid")
 
-    def start_loop(self):
-        self.loop: LoopHandler = None
-        if self.args.loopmode == "dynamic":
-            self.loop = DynamicLoop(self.args.looptime)
+        return mailconf, jiraconf
+
+    def create_routes(self) -> List[Route]:
+        """Create all routes, connecting to their mailboxes
+
+        Without a routes file, a single default route is created from the command line arguments. Routes using the
+        same Jira account share one Jira session, and routes using the same SMTP account share one SMTP connection.
+        """
+        if self.args.routes:
+            routeoptions = routing.load_routes(Path(self.args.routes))
+        else:
+            routeoptions = [("", {})]
+
+        sessions: Dict[Tuple, JiraSession] = {}
+        exporters: Dict[Tuple, MailExporter] = {}
+        filters: Dict[str, MailFilter] = {}
+        routes: List[Route] = []
+        for name, options in routeoptions:
+            args = argparse.Namespace(**vars(self.args))
+            vars(args).update(options)
+            for option in routing.ROUTE_OPTIONS:
+                if getattr(args, option) is None:
+                    raise Exception("Option '%s' must be set for route '%s'" % (option, name or "default"))
+
+            if name:
+                log.info("Setting up route '%s'", name)
+            mailconf, jiraconf = self.populate_config(args)
+
+            jirakey = (jiraconf.jiraHost, jiraconf.jiraUser, jiraconf.jiraToken)
+            if jirakey not in sessions:
+                sessions[jirakey] = JiraSession(jiraconf, self.issueindex, poolsize=self.args.workers)
+            sessions[jirakey].warm_index(jiraconf.project)
+
+            smtpkey = (mailconf.SMTPHost, mailconf.SMTPPort, mailconf.SMTPUser)
+            if smtpkey not in exporters:
+                exporters[smtpkey] = MailExporter(mailconf)
+            exporters[smtpkey].load_templates(mailconf.threadStartTemplate)
+
+            mailfilter = None
+            if args.filterconfig:
+                if args.filterconfig not in filters:
+                    filters[args.filterconfig] = MailFilter(Path(args.filterconfig))
+                mailfilter = filters[args.filterconfig]
+
+            workqueue = None
+            if self.queued:
+                workqueue = WorkQueue(Path(self.args.statedb), mailconf, name)
+
+            routes.append(Route(name, mailconf, jiraconf, MailImporter(mailconf), exporters[smtpkey],
+                                sessions[jirakey], mailfilter, workqueue))
+
+        routing.check_routes(routes)
+        return routes
+
+    def create_loop(self, route: Route = None) -> LoopHandler:
+        """Create the loop handler for the configured loop mode
+
+        Args:
+            route: Route the loop waits for mail of in idle mode. If None, the loop serves all routes.
+        """
         if self.args.loopmode == "interval":
-            self.loop = IntervalLoop(self.args.looptime)
+            return IntervalLoop(self.args.looptime)
+        if self.args.loopmode == "idle":
+            if route is None and len(self.routes) > 1:
+                log.warning("IMAP IDLE can only wait for a single mailbox, falling back to polling every %is",
+                            self.args.looptime)
+                return DynamicLoop(self.args.looptime)
+            return IdleLoop(self.args.looptime, (route or self.routes[0]).importer, self.args.idletime)
         if self.args.loopmode == "singleshot":
-            self.loop = Singleshot(self.args.looptime)
+            return Singleshot(self.args.looptime)
+        return DynamicLoop(self.args.looptime)
+
+    def start_loop(self):
+        self.loop: LoopHandler = self.create_loop()
 
         while self.loop.continuerunning:
             if self.loop.tick():
-                avail_uids: List[int] = self.importer.get_mail_list()
+                self.run_cycle()
 
-                for uid in avail_uids:
-                    self.process_mail(uid)
+    def run_cycle(self):
+        """Fetch all available mails of all routes and process them
 
-                self.move_threadstarters()
+        Routes take turns, each importing at most --routebatch mails per turn, until no route has mails left. A
+        flooded mailbox therefore doesn't hold up the others, and neither does a failing one."""
+        if self.ledger is not None:
+            self.ledger.compact()
 
-    def process_mail(self, uid: int) -> bool:
-        """process a single mail from currently available mails
+        # Start with a different route every cycle
+        self.routes.append(self.routes.pop(0))
+
+        attempted: Dict[str, Set[int]] = {route.name: set() for route in self.routes}
+        pending: List[Route] = list(self.routes)
+        with metrics.timed("cycle"):
+            while pending:
+                remaining: List[Route] = []
+                for route in pending:
+                    try:
+                        if self.run_route_cycle(route, attempted[route.name]):
+                            remaining.append(route)
+                    except Exception as e:
+                        self.route_failed(route, e)
+                pending = remaining
+
+        self.metricssummary.log_if_due()
+
+    def run_route_cycle(self, route: Route, attempted: Set[int]) -> bool:
+        """Fetch available mails of a route and process up to --routebatch of them
 
         Args:
-            uid: uid of email that shall be processed
+            route: Route whose mails shall be processed
+            attempted: UIDs that have been processed during this cycle already, updated with those processed now
 
         Returns:
-            Success of processing
+            Whether mails are left that haven't been processed yet
+        """
+        if route.mailfilter is not None:
+            route.mailfilter.reload_if_changed()
+        route.exporter.reload_templates()
+
+        avail_uids: List[int] = route.importer.get_mail_list()
+        # Mails whose move failed have been dealt with already, only the move is retried
+        avail_uids = [uid for uid in avail_uids if uid not in route.importer.moveuids]
+        if route.workqueue is not None:
+            # Queued mails have been fetched already
+            queued = route.workqueue.queued_uids(route.importer.uidvalidity)
+            avail_uids = [uid for uid in avail_uids if uid not in queued]
+        avail_uids = [uid for uid in avail_uids if uid not in attempted]
+        batch = avail_uids[:self.args.routebatch] if self.args.routebatch > 0 else avail_uids
+        attempted.update(batch)
+
+        # Let the server find blacklisted mails, so they aren't fetched at all
+        filtered = self.search_filtered(route, batch)
+        route.importer.moveuids.update(filtered)
+
+        # Decide on everything that can be decided from headers alone, before downloading full mails
+        tickets: List[ProcessedMail] = []
+        for mail in route.importer.fetch_many([uid for uid in batch if uid not in filtered], headeronly=True):
+            mail.route = route.name
+            if not self.prefilter_mail(mail):
+                tickets.append(mail)
+
+        if route.workqueue is None:
+            route.jirasession.prefetch([mail.prefixedhash for mail in tickets], route.jiraconf.project)
+            try:
+                self.import_mails(route.importer.fetch_bodies(tickets))
+            finally:
+                # Also move the mails imported before a failure, so they aren't imported again after a restart
+                route.importer.commit_moves()
+        else:
+            for mail in route.importer.fetch_bodies(tickets):
+                route.workqueue.enqueue(mail, route.importer.uidvalidity)
+            self.drain_queue(route)
+
+        return len(batch) < len(avail_uids)
+
+    def route_failed(self, route: Route, error: Exception) -> None:
+        """Log a failed cycle of a route and reconnect its mailbox if the connection broke
+
+        The other routes carry on, the failed route is tried again in the next cycle."""
+        log.error("Processing route '%s' failed: %s", route, error, route=str(route))
+        metrics.count("jicket_route_errors_total", route=str(route))
+        if isinstance(error, (imaplib.IMAP4.abort, OSError)):
+            try:
+                route.importer.login()
+            except Exception as e:
+                log.error("Reconnecting to the mailbox of route '%s' failed: %s", route, e, route=str(route))
+
+    def search_filtered(self, route: Route, uids: List[int]) -> Set[int]:
+        """Search the inbox for mails that are filtered by blacklist rules the IMAP server can apply
+
+        Returns:
+            UIDs of filtered mails, which can be moved without fetching them
         """
-        mail: ProcessedMail = self.importer.fetchMail(uid)
+        if route.mailfilter is None or not route.mailfilter.blacklistqueries or not uids:
+            return set()
+
+        blacklisted = set()
+        for query in route.mailfilter.blacklistqueries:
+            matches = route.importer.search(query, uids)
+            if matches is None:
+                return set()    # Leave it to the regular filtering
+            blacklisted.update(matches)
+
+        for query in route.mailfilter.whitelistqueries:
+            if not blacklisted:
+                break
+            matches = route.importer.search(query, sorted(blacklisted))
+            if matches is None:
+                return set()
+            blacklisted.difference_update(matches)
+
+        if blacklisted:
+            log.info("%i mail(s) were filtered by the IMAP server without fetching them", len(blacklisted))
+            metrics.count("jicket_mails_filtered_total", len(blacklisted), where="server")
+        return blacklisted
+
+    def route_of(self, mail: ProcessedMail) -> Route:
+        """Get the route a mail was fetched through"""
+        return self.routesbyname[mail.route]
+
+    def import_mails(self, mails: Iterable[ProcessedMail]):
+        """Import mails into Jira, concurrently if multiple workers are configured"""
+        handler = self.consume_mail if self.queued else self.process_mail
+        try:
+            for mail in mails:
+                if self.pipeline is not None:
+                    self.pipeline.submit(mail)
+                else:
+                    handler(mail)
+        finally:
+            if self.pipeline is not None:
+                self.pipeline.join()
+
+    def drain_queue(self, route: Route):
+        """Import all due mails of a route's work queue and move imported mails out of the inbox"""
+        mails = route.workqueue.due()
+        if mails:
+            log.info("Importing %i queued mail(s), %i in queue", len(mails), len(route.workqueue))
+        route.jirasession.prefetch([mail.prefixedhash for mail in mails], route.jiraconf.project)
+        self.import_mails(mails)
+
+        # Also retries moves that failed in previous cycles
+        uidvalidity = route.importer.uidvalidity
+        completed = route.workqueue.completed_uids(uidvalidity)
+        route.importer.moveuids.update(completed)
+        route.importer.commit_moves()
+        route.workqueue.remove_completed(uidvalidity, completed - route.importer.moveuids)
+        metrics.gauge("jicket_queue_depth", len(route.workqueue), queue="work", route=str(route))
+
+    def prefilter_mail(self, mail: ProcessedMail) -> bool:
+        """Filter and move mails that don't need to be imported into Jira
+
+        Only uses the headers of a mail, so it can be called before the mail body is fetched. This is also where thread
+        starters are recognized, which are then moved along with the other mails of the cycle.
 
-        if self.mailfilter is not None:
-            filtered, reason = self.mailfilter.filtermail(mail)
+        Args:
+            mail: email that shall be checked
+
+        Returns:
+            Whether the mail has been dealt with and must not be processed further
+        """
+        route = self.route_of(mail)
+        if route.mailfilter is not None:
+            filtered, reason = route.mailfilter.filtermail(mail)
             if filtered:
-                log.info("Mail '%s' from '%s' was filtered for the following reason(s):" % (
-                    mail.subject, mail.parsed["from"]))
+                log.info("Mail '%s' from '%s' was filtered for the following reason(s):", mail.subject,
+                         mail.parsed["from"], stage="filter", **log.mailcontext(mail))
                 for r in reason:  # Print the reasons for filtering
-                    log.info(r)
-                self.importer.moveImported(mail)
+                    log.info(r, stage="filter", **log.mailcontext(mail))
+                metrics.count("jicket_mails_filtered_total", where="client")
+                route.importer.moveImported(mail)
                 return True
             elif reason:
-                log.info(
-                    "Mail '%s' was filtered but saved by a whitelist for following reason(s):" % mail.subject)
+                log.info("Mail '%s' was filtered but saved by a whitelist for following reason(s):", mail.subject,
+                         stage="filter", **log.mailcontext(mail))
                 for r in reason:  # Print the reasons for filtering
-                    log.info(r)
+                    log.info(r, stage="filter", **log.mailcontext(mail))
 
-            if mail.threadstarter:
-                self.importer.moveImported(mail)
-                return True
+        if mail.threadstarter:
+            metrics.count("jicket_threadstarters_total", direction="received")
+            route.importer.moveImported(mail)
+            return True
 
-            # Mail is completely new ticket or reply to ticket
-            jiraint = jiraintegration.JiraIntegration(mail, self.jiraconf)
-            success, newissue = jiraint.processMail()
+        return False
+
+    def process_mail(self, mail: ProcessedMail) -> bool:
+        """process a single mail from currently available mails
+
+        Args:
+            mail: email that shall be processed, with prefilter_mail already applied
+
+        Returns:
+            Success of processing
+        """
+        try:
+            success = self.apply_mail(mail)
+        finally:
+            mail.cleanup()
+
+        self.route_of(mail).importer.moveImported(mail)
+        return success
+
+    def consume_mail(self, mail: ProcessedMail) -> bool:
+        """Import a mail from the work queue, scheduling a retry if it fails
+
+        The mail is only moved out of the inbox once it has been imported successfully. If an earlier mail of the same
+        ticket has failed, the mail is left in the queue as it is, to be imported after that one.
+
+        Returns:
+            Success of processing
+        """
+        route = self.route_of(mail)
+        if route.workqueue.held_back(mail):
+            log.info("Mail '%s' waits for the retry of an earlier mail of its ticket", mail.subject,
+                     **log.mailcontext(mail))
+            return False
 
-            # If mail was new ticket, start a new email thread
-            if newissue:
-                mailexporter = mailhandling.MailExporter(self.mailconf)
+        try:
+            success = self.apply_mail(mail)
+        except Exception as e:
+            log.error("Importing mail '%s' failed: %s", mail.subject, e, **log.mailcontext(mail))
+            success = False
 
-                mailexporter.login()
-                mailexporter.sendTicketStart(mail)
-                mailexporter.quit()
+        if success:
+            route.workqueue.complete(mail)
+            route.importer.moveImported(mail)
+        else:
+            delay = route.workqueue.retry(mail)
+            log.warning("Import of mail '%s' will be retried in %is", mail.subject, delay, **log.mailcontext(mail))
+        return success
+
+    def apply_mail(self, mail: ProcessedMail) -> bool:
+        """Create or update the Jira issue of a mail and send out a thread starter for new issues
+
+        Returns:
+            Success of Jira import
+        """
+        success, newissue = self.apply_jira(mail)
 
-            self.importer.moveImported(mail)
+        # If mail was new ticket, start a new email thread
+        if newissue:
+            self.apply_threadstart(mail)
 
-    def move_threadstarters(self):
-        avail_uids: List[int] = self.importer.get_mail_list()
+        return success
 
-        for uid in avail_uids:
-            mail: ProcessedMail = self.importer.fetchMail(uid)
-            if mail.threadstarter:
-                self.importer.moveImported(mail)
+    def apply_jira(self, mail: ProcessedMail) -> Tuple[bool, bool]:
+        """Create or update the Jira issue of a mail, unless the ledger shows this has been done already
+
+        Returns:
+            Tuple indicating the jira import success and if this is a new issue
+        """
+        if self.ledger is not None:
+            key = ledger.mailkey(mail)
+            steps = self.ledger.steps(key)
+            if ledger.STEP_JIRA in steps:
+                log.info("Mail '%s' has already been imported into Jira, skipping import", mail.subject,
+                         **log.mailcontext(mail))
+                metrics.count("jicket_mails_imported_total", result="duplicate")
+                return True, steps[ledger.STEP_JIRA]
+
+        # Mail is completely new ticket or reply to ticket
+        route = self.route_of(mail)
+        jiraint = jiraintegration.JiraIntegration(mail, route.jiraconf, route.jirasession)
+        try:
+            success, newissue = jiraint.processMail()
+        except Exception:
+            metrics.count("jicket_mails_imported_total", result="failure")
+            raise
+        metrics.count("jicket_mails_imported_total", result="success" if success else "failure")
+        if success and self.ledger is not None:
+            self.ledger.record(key, ledger.STEP_JIRA, newissue)
+        return success, newissue
+
+    def apply_threadstart(self, mail: ProcessedMail) -> None:
+        """Send the thread starter mail for a new issue, unless the ledger shows it has been sent already"""
+        if self.ledger is not None:
+            key = ledger.mailkey(mail)
+            if ledger.STEP_THREADSTART in self.ledger.steps(key):
+                return
+
+        self.route_of(mail).exporter.sendTicketStart(mail)
+        if self.ledger is not None:
+            self.ledger.record(key, ledger.STEP_THREADSTART)
@@ -0,0 +1,183 @@
+"""
+Jicket application running on asyncio
+
+IMAP fetching, Jira imports and SMTP sends run as separate tasks, connected by bounded queues. A slow Jira or SMTP
+server therefore only stalls its own stage, while fetching blocks once the queues are full. The underlying clients
+(imaplib, jira, smtplib) are blocking, so their calls are run in a thread pool without blocking the event loop.
+
+Each route has its own IMAP task, so mailboxes are polled (or idle) independently. The Jira and SMTP tasks are shared
+by all routes, which take turns in the order their mails were fetched. A route only waits for its own mails before it
+moves them and starts its next cycle.
+"""
+
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Callable, Deque, Dict, List
+
+import jicket.log as log
+import jicket.metrics as metrics
+from jicket.app import JicketApp
+from jicket.mailprocessor import ProcessedMail
+from jicket.routing import Route
+
+QUEUE_SIZE = 100    # Maximum number of mails waiting in each stage
+
+
+class AsyncJicketApp(JicketApp):
+    def __init__(self):
+        super().__init__()
+
+        if self.queued:
+            raise Exception("The queued pipeline is not supported by the asyncio runtime")
+        if self.pipeline is not None:
+            # Concurrency is provided by the Jira tasks instead
+            self.pipeline.shutdown()
+            self.pipeline = None
+
+        self.executor: ThreadPoolExecutor = None
+        self.jiraqueue: asyncio.Queue = None    # Fetched mails waiting for Jira import
+        self.smtpqueue: asyncio.Queue = None    # Mails of new issues waiting for their thread starter
+        self.ticketqueues: Dict[str, Deque[ProcessedMail]] = {}   # Waiting mails of tickets being imported
+        self.inflight: Dict[str, int] = {}  # Number of mails of a route that are queued or being processed
+        self.settled: Dict[str, asyncio.Event] = {}     # Set while no mails of a route are in flight
+
+    def start_loop(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        workers = max(1, self.args.workers)
+        # One thread per Jira task and route, plus SMTP
+        self.executor = ThreadPoolExecutor(max_workers=workers + len(self.routes) + 1)
+        self.jiraqueue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.smtpqueue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        for route in self.routes:
+            self.inflight[route.name] = 0
+            self.settled[route.name] = asyncio.Event()
+            self.settled[route.name].set()
+
+        tasks = [asyncio.ensure_future(self.jira_task()) for _ in range(workers)]
+        tasks.append(asyncio.ensure_future(self.smtp_task()))
+        try:
+            await asyncio.gather(*[self.imap_task(route) for route in self.routes])
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.executor.shutdown(wait=True)
+
+    async def blocking(self, func: Callable, *args):
+        """Run a blocking function in the thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def imap_task(self, route: Route):
+        """Wait for and fetch new mails of a route, and move processed mails once a cycle is complete"""
+        loop = self.create_loop(route)
+        while loop.continuerunning:
+            if await self.blocking(loop.tick):
+                with metrics.timed("cycle"):
+                    try:
+                        await self.run_cycle_async(route)
+                    except Exception as e:
+                        # Don't take down the other routes
+                        await self.blocking(self.route_failed, route, e)
+                self.metricssummary.log_if_due()
+
+    async def run_cycle_async(self, route: Route):
+        if route.mailfilter is not None:
+            route.mailfilter.reload_if_changed()
+        route.exporter.reload_templates()
+        if self.ledger is not None:
+            self.ledger.compact()
+
+        avail_uids: List[int] = await self.blocking(route.importer.get_mail_list)
+        # Mails whose move failed have been dealt with already, only the move is retried
+        avail_uids = [uid for uid in avail_uids if uid not in route.importer.moveuids]
+
+        # Let the server find blacklisted mails, so they aren't fetched at all
+        filtered = await self.blocking(self.search_filtered, route, avail_uids)
+        route.importer.moveuids.update(filtered)
+        avail_uids = [uid for uid in avail_uids if uid not in filtered]
+
+        # Decide on everything that can be decided from headers alone, before downloading full mails
+        headers = await self.blocking(lambda: list(route.importer.fetch_many(avail_uids, headeronly=True)))
+        for mail in headers:
+            mail.route = route.name
+        tickets = [mail for mail in headers if not self.prefilter_mail(mail)]
+
+        await self.blocking(route.jirasession.prefetch, [mail.prefixedhash for mail in tickets],
+                            route.jiraconf.project)
+        bodies = route.importer.fetch_bodies(tickets)
+        try:
+            while True:
+                mail = await self.blocking(next, bodies, None)
+                if mail is None:
+                    break
+                self.inflight[route.name] += 1
+                self.settled[route.name].clear()
+                await self.jiraqueue.put(mail)   # Waits while the Jira tasks are busy
+                metrics.gauge("jicket_queue_depth", self.jiraqueue.qsize(), queue="jira")
+        finally:
+            # Mails of other routes may still be in the queues, only wait for those of this route. Mails imported
+            # before a failure are moved as well, so they aren't imported again after a restart.
+            await self.settled[route.name].wait()
+            await self.blocking(route.importer.commit_moves)
+
+    def settle(self, mail: ProcessedMail) -> None:
+        """Mark a mail as completely processed, successfully or not"""
+        self.inflight[mail.route] -= 1
+        if not self.inflight[mail.route]:
+            self.settled[mail.route].set()
+
+    async def jira_task(self):
+        """Import mails into Jira
+
+        Mails belonging to the same ticket are imported one after another in the order they were fetched. Like in
+        TicketPipeline, the task busy with a ticket picks up mails of that ticket arriving in the meantime, so other
+        tasks don't wait for it and continue with other tickets."""
+        while True:
+            mail: ProcessedMail = await self.jiraqueue.get()
+            metrics.gauge("jicket_queue_depth", self.jiraqueue.qsize(), queue="jira")
+            if mail.prefixedhash in self.ticketqueues:
+                self.ticketqueues[mail.prefixedhash].append(mail)
+                continue
+
+            queue = self.ticketqueues[mail.prefixedhash] = deque([mail])
+            while queue:
+                await self.import_mail(queue.popleft())
+            del self.ticketqueues[mail.prefixedhash]
+
+    async def import_mail(self, mail: ProcessedMail):
+        """Import a single mail into Jira and pass it on to the SMTP task if it opened a new issue"""
+        try:
+            try:
+                success, newissue = await self.blocking(self.apply_jira, mail)
+            finally:
+                mail.cleanup()
+        except Exception as e:
+            # Mail stays in the inbox and is retried on the next cycle
+            log.error("Processing mail '%s' failed: %s", mail.subject, e, **log.mailcontext(mail))
+            self.settle(mail)
+            return
+
+        if newissue:
+            await self.smtpqueue.put(mail)  # Settled by the SMTP task
+            metrics.gauge("jicket_queue_depth", self.smtpqueue.qsize(), queue="smtp")
+        else:
+            self.route_of(mail).importer.moveImported(mail)
+            self.settle(mail)
+
+    async def smtp_task(self):
+        """Send thread starter mails for new issues"""
+        while True:
+            mail: ProcessedMail = await self.smtpqueue.get()
+            metrics.gauge("jicket_queue_depth", self.smtpqueue.qsize(), queue="smtp")
+            try:
+                await self.blocking(self.apply_threadstart, mail)
+                self.route_of(mail).importer.moveImported(mail)
+            except Exception as e:
+                log.error("Sending thread starter for mail '%s' failed: %s", mail.subject, e, stage="smtp_send",
+                          **log.mailcontext(mail))
+            finally:
+                self.settle(mail)
@@ -17,10 +17,14 @@ class MailConfig():
         self.SMTPPort = 587  # type: int
         self.SMTPUser = None  # type: str
         self.SMTPPass = None  # Type: str
+        self.SMTPIdleTimeout = 300  # type: int   # Time after which an idle SMTP session is not reused anymore
 
         self.folderInbox = "INBOX"  # type: str               # Folder from which incoming messages are retrieved
         self.folderSuccess = "jicket-incoming"  # type: str   # Where mails shall be put after import
         self.threadStartTemplate = Path("threadtemplate.html")  # type: Path
+        self.fetchBatchSize = 50  # type: int   # Number of mails fetched with a single IMAP command
+        self.maxBodyLength = 32000  # type: int   # Maximum length of text imported from a mail, 0 for unlimited
+        self.maxAttachmentSize = 10 * 1024 * 1024  # type: int   # Larger attachments are skipped, 0 to skip all
 
         self.ticketAddress = None  # type: str # Address of jicket mailbox
 
@@ -38,6 +42,15 @@ class MailConfig():
         if self.idMinLength < 0:
             raise Exception("Minimum ID length must be 0 or greater (is: %s)" % self.idMinLength)
 
+        if self.maxBodyLength < 0:
+            raise Exception("Maximum body length must be 0 or greater (is: %s)" % self.maxBodyLength)
+
+        if self.maxAttachmentSize < 0:
+            raise Exception("Maximum attachment size must be 0 or greater (is: %s)" % self.maxAttachmentSize)
+
+        if self.fetchBatchSize < 1:
+            raise Exception("Fetch batch size must be 1 or greater (is: %s)" % self.fetchBatchSize)
+
         return True
 
 
@@ -46,4 +59,12 @@ class JiraConfig():
         self.jiraHost: str = None  # Host URL of Jira
         self.jiraUser: str = None  # User for logging in
         self.jiraPass: str = None  # Pass for user
+        self.jiraToken: str = None  # Personal access token, used instead of user and pass if set
         self.project: str = None  # Project under which issues shall be added
+
+    def checkValidity(self) -> bool:
+        """Checks if configuration parameters are valid"""
+        if not self.jiraToken and not self.jiraPass:
+            raise Exception("Either a Jira password or a Jira access token must be given")
+
+        return True
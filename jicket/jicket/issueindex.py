@@ -0,0 +1,63 @@
+"""Local index of ticket hashes to Jira issue keys
+
+Allows replies to be matched to their issue without a JQL search. Jira remains the source of truth, the index can be
+deleted at any time."""
+
+import sqlite3
+import threading
+from pathlib import Path
+
+from typing import List
+
+
+class IssueIndex():
+    """Persistent mapping of prefixed ticket hashes to Jira issue keys, stored in an SQLite database"""
+    def __init__(self, path: Path):
+        self.path = path    # type: Path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS issueindex ("
+                            "prefixedhash TEXT NOT NULL, "
+                            "issuekey TEXT NOT NULL, "
+                            "PRIMARY KEY (prefixedhash, issuekey))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS attachments ("
+                            "issuekey TEXT NOT NULL, "
+                            "sha256 TEXT NOT NULL, "
+                            "PRIMARY KEY (issuekey, sha256))")
+
+    def get(self, prefixedhash: str) -> List[str]:
+        """Get keys of all issues known for a ticket
+
+        Returns:
+            List of issue keys, empty if the ticket is unknown
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT issuekey FROM issueindex WHERE prefixedhash = ?", (prefixedhash,))
+            return [row[0] for row in rows]
+
+    def add(self, prefixedhash: str, issuekey: str) -> None:
+        """Add an issue to a ticket"""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO issueindex (prefixedhash, issuekey) VALUES (?, ?)",
+                            (prefixedhash, issuekey))
+
+    def remove(self, prefixedhash: str) -> None:
+        """Remove all issues of a ticket, e.g. because they no longer exist in Jira"""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM issueindex WHERE prefixedhash = ?", (prefixedhash,))
+
+    def has_attachment(self, issuekey: str, sha256: str) -> bool:
+        """Whether a file with the given content hash has been uploaded to the issue"""
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM attachments WHERE issuekey = ? AND sha256 = ?", (issuekey, sha256))
+            return row.fetchone() is not None
+
+    def add_attachment(self, issuekey: str, sha256: str) -> None:
+        """Remember that a file has been uploaded to the issue"""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO attachments (issuekey, sha256) VALUES (?, ?)", (issuekey, sha256))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM issueindex").fetchone()[0]
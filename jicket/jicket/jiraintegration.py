@@ -1,36 +1,201 @@
 """Creates or updates issue from Mail"""
 
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Set, Union
 from jicket.mailhandling import ProcessedMail
 import jira
+import requests.adapters
+import requests.exceptions
 import jicket.log as log
+import jicket.metrics as metrics
 import html2text
 import re
 from jicket.config import JiraConfig
+from jicket.issueindex import IssueIndex
+
+
+INDEX_WARM_LIMIT = 1000    # Number of most recent issues used to warm up the issue index
+LOOKUP_BATCH_SIZE = 50  # Number of tickets resolved with a single JQL query
+
+
+def summaryhashes(summary: str) -> List[str]:
+    """Get all prefixed ticket hashes (e.g. JI-ABC123 for '[#JI-ABC123] Subject') contained in an issue summary"""
+    return re.findall("\\[#([^\\]\\s]+)\\]", summary)
+
+
+class JiraSession():
+    """Long-lived, authenticated Jira client that is shared between JiraIntegration instances
+
+    The underlying HTTP session keeps its connections alive, so the TLS handshake and authentication only happen once
+    instead of for every mail."""
+    def __init__(self, config: JiraConfig, index: IssueIndex = None, poolsize: int = 1):
+        self.config = config    # type: JiraConfig
+        self.index = index  # type: IssueIndex   # Local index of ticket hashes to issue keys, if any
+        self.poolsize = poolsize    # type: int   # Number of HTTP connections kept open, one per concurrent worker
+        self._jira = None   # type: jira.JIRA
+        self.lookups = {}   # type: Dict[str, Dict[str, List[str]]]   # Prefetched issue keys per project and ticket
+        self.attachments = {}   # type: Dict[str, Set[str]]   # Hashes of files uploaded per issue key
+
+    @property
+    def jira(self) -> jira.JIRA:
+        """Jira client, connecting on first use"""
+        if self._jira is None:
+            self.connect()
+        return self._jira
+
+    def connect(self) -> None:
+        """(Re-)connect and authenticate to Jira"""
+        if self.config.jiraToken:
+            self._jira = jira.JIRA(self.config.jiraHost, token_auth=self.config.jiraToken)
+        else:
+            self._jira = jira.JIRA(self.config.jiraHost, basic_auth=(self.config.jiraUser, self.config.jiraPass))
+
+        if self.poolsize > 1:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.poolsize)
+            self._jira._session.mount("https://", adapter)
+            self._jira._session.mount("http://", adapter)
+
+    def call(self, method: str, *args, **kwargs):
+        """Call a method of the Jira client, reconnecting once if the authentication has expired"""
+        try:
+            with metrics.timed("jira_" + method):
+                try:
+                    return getattr(self.jira, method)(*args, **kwargs)
+                except jira.exceptions.JIRAError as e:
+                    if e.status_code != 401:
+                        raise
+                    log.warning("Jira authentication expired, reconnecting")
+                    self.connect()
+                    return getattr(self.jira, method)(*args, **kwargs)
+        except jira.exceptions.JIRAError:
+            metrics.count("jicket_jira_errors_total", method=method)
+            raise
+
+
+    def warm_index(self, project: str = None, limit: int = INDEX_WARM_LIMIT) -> None:
+        """Add the most recently created issues of a project to the issue index
+
+        The index is only a cache, so if Jira can't be reached, this is skipped and tickets are looked up as usual.
+
+        Args:
+            project: Key of the project, defaults to the project of the session's config
+        """
+        if self.index is None:
+            return
+
+        project = project or self.config.project
+        try:
+            issues = self.call("search_issues", "project = %s ORDER BY created DESC" % project,
+                               maxResults=limit, fields="summary")
+        except (jira.exceptions.JIRAError, requests.exceptions.RequestException) as e:
+            log.warning("Failed to warm up the issue index, continuing without: %s", e)
+            return
+        for issue in issues:
+            for prefixedhash in summaryhashes(issue.fields.summary):
+                self.index.add(prefixedhash, issue.key)
+        log.info("Issue index contains %i issue(s)", len(self.index))
+
+    def has_attachment(self, issuekey: str, sha256: str) -> bool:
+        """Whether a file with the given hash has already been uploaded to the issue"""
+        if sha256 in self.attachments.get(issuekey, ()):
+            return True
+        return self.index is not None and self.index.has_attachment(issuekey, sha256)
+
+    def add_attachment(self, issuekey: str, sha256: str) -> None:
+        """Remember that a file has been uploaded to the issue"""
+        self.attachments.setdefault(issuekey, set()).add(sha256)
+        if self.index is not None:
+            self.index.add_attachment(issuekey, sha256)
+
+    def prefetch(self, prefixedhashes: List[str], project: str = None) -> None:
+        """Resolve the issues of multiple tickets at once
+
+        Tickets that are not in the issue index are searched with one JQL query per LOOKUP_BATCH_SIZE tickets, instead
+        of one query per mail. Results replace those of the previous prefetch for the same project.
+
+        Args:
+            prefixedhashes: Prefixed hashes of the tickets
+            project: Key of the project, defaults to the project of the session's config
+        """
+        project = project or self.config.project
+        lookups = {}    # type: Dict[str, List[str]]
+        self.lookups[project] = lookups
+        missing = []
+        for prefixedhash in set(prefixedhashes):
+            if self.index is not None and self.index.get(prefixedhash):
+                continue
+            missing.append(prefixedhash)
+
+        for i in range(0, len(missing), LOOKUP_BATCH_SIZE):
+            chunk = missing[i:i + LOOKUP_BATCH_SIZE]
+            summaryquery = " OR ".join("summary~'\\\\[\\\\#%s\\\\]'" % h for h in chunk)
+            try:
+                issues = self.call("search_issues", "project = %s AND (%s)" % (project, summaryquery),
+                                   maxResults=False, fields="summary")
+            except jira.exceptions.JIRAError as e:
+                log.warning("Failed to look up tickets in Jira: %s", e.text)
+                continue
+
+            for prefixedhash in chunk:
+                lookups[prefixedhash] = []
+            for issue in issues:
+                for prefixedhash in summaryhashes(issue.fields.summary):
+                    if prefixedhash in lookups:
+                        lookups[prefixedhash].append(issue.key)
+                        if self.index is not None:
+                            self.index.add(prefixedhash, issue.key)
 
 
 class JiraIntegration():
-    def __init__(self, mail: ProcessedMail, config: JiraConfig):
+    def __init__(self, mail: ProcessedMail, config: JiraConfig, session: JiraSession = None):
         self.mail = mail    # type: ProcessedMail
         self.config = config    # type: JiraConfig
 
-        self.jira = jira.JIRA(self.config.jiraHost, basic_auth=(self.config.jiraUser, self.config.jiraPass))
+        if session is None:
+            session = JiraSession(config)
+        self.session = session  # type: JiraSession
 
-    def getattachments(self) -> None:
-        """Fetch all attachments"""
-        pass
+    def addattachments(self, issue: Union[jira.Issue, str]) -> None:
+        """Upload attachments of mail to issue, skipping files that have already been uploaded to it"""
+        issuekey = issue if isinstance(issue, str) else issue.key
+        for attachment in self.mail.attachments:
+            if self.session.has_attachment(issuekey, attachment.sha256):
+                log.info("Attachment '%s' already exists on %s", attachment.filename, issuekey,
+                         **log.mailcontext(self.mail))
+                continue
+            try:
+                with attachment.path.open("rb") as f:
+                    self.session.call("add_attachment", issuekey, attachment=f, filename=attachment.filename)
+            except jira.exceptions.JIRAError as e:
+                # The mail itself has been imported, so a failed attachment must not cause a re-import
+                log.error("Failed to upload attachment '%s' to %s: %s", attachment.filename, issuekey, e.text,
+                          **log.mailcontext(self.mail))
+                continue
+            self.session.add_attachment(issuekey, attachment.sha256)
 
     def processMail(self) -> Tuple[bool, bool]:
         """Updates or creates new issue from mail
 
         :returns: Tuple[bool, bool] Tuple indicating the jira import success and if this is a new issue"""
-        self.getattachments()
-
-        issues = self.findIssue()
         try:
+            issues = self.findIssue()
             if issues:
-                for issue in issues:
-                    self.updateIssue(issue)
+                try:
+                    for issue in issues:
+                        self.updateIssue(issue)
+                except jira.exceptions.JIRAError as e:
+                    if e.status_code != 404 or self.session.index is None:
+                        raise
+                    # Indexed issue might have been deleted or moved, so fall back to searching Jira
+                    log.warning("Indexed issue for #%s not found, removing it from index", self.mail.prefixedhash,
+                                **log.mailcontext(self.mail))
+                    self.session.index.remove(self.mail.prefixedhash)
+                    self.session.lookups.get(self.config.project, {}).pop(self.mail.prefixedhash, None)
+                    issues = self.findIssue()
+                    if not issues:
+                        self.newIssue()
+                        return (True, True)
+                    for issue in issues:
+                        self.updateIssue(issue)
                 return (True, False)
             else:
                 self.newIssue()
@@ -38,15 +203,35 @@ class JiraIntegration():
         except jira.exceptions.JIRAError:
             return False, False
 
-    def findIssue(self) -> List[jira.Issue]:
-        """Check if issue for ticketid exists already"""
-        issues = self.jira.search_issues("project = %s AND summary~'\\\\[\\\\#%s\\\\]'" % (self.config.project, self.mail.prefixedhash))
+    def findIssue(self) -> List[Union[jira.Issue, str]]:
+        """Check if issue for ticketid exists already
+
+        Returns:
+            Issues (or issue keys, if found in the issue index) belonging to the ticket
+        """
+        if self.session.index is not None:
+            issuekeys = self.session.index.get(self.mail.prefixedhash)
+            if issuekeys:
+                return issuekeys
+        lookups = self.session.lookups.get(self.config.project, {})
+        if self.mail.prefixedhash in lookups:
+            return lookups[self.mail.prefixedhash]
+
+        issues = self.session.call("search_issues", "project = %s AND summary~'\\\\[\\\\#%s\\\\]'" % (
+            self.config.project, self.mail.prefixedhash))
+        # The text search is fuzzy, so only accept issues whose summary really contains the ticket ID, like prefetch
+        issues = [issue for issue in issues if self.mail.prefixedhash in summaryhashes(issue.fields.summary)]
+
+        if self.session.index is not None:
+            for issue in issues:
+                self.session.index.add(self.mail.prefixedhash, issue.key)
 
         return issues
 
     def newIssue(self):
         """Create a new issue from Mail"""
-        log.info("Creating new Issue for #%s in project %s" % (self.mail.prefixedhash, self.config.project))
+        log.info("Creating new Issue for #%s in project %s", self.mail.prefixedhash, self.config.project,
+                 **log.mailcontext(self.mail))
 
         # Construct string for description
         description = ""
@@ -54,8 +239,6 @@ class JiraIntegration():
         description += "From: %s\n\n\n" % self.mail.parsed["From"]
         description += self.mail.textfrombodies()
 
-        # TODO: Attachments
-
         issuedict = {
             "project": {"key": self.config.project},
             "summary": "[#%s] %s" % (self.mail.prefixedhash, self.mail.subject),
@@ -63,14 +246,22 @@ class JiraIntegration():
             "issuetype": {"name": "Task"}
         }
 
-        self.jira.create_issue(fields=issuedict)
+        issue = self.session.call("create_issue", fields=issuedict)
+        self.session.lookups.setdefault(self.config.project, {})[self.mail.prefixedhash] = [issue.key]
+        if self.session.index is not None:
+            self.session.index.add(self.mail.prefixedhash, issue.key)
 
-    def updateIssue(self, issue: jira.Issue):
+        self.addattachments(issue)
+
+    def updateIssue(self, issue: Union[jira.Issue, str]):
         """Update issue from mail"""
-        log.info("Updating Issue for #%s in project %s" % (self.mail.prefixedhash, self.config.project))
+        log.info("Updating Issue for #%s in project %s", self.mail.prefixedhash, self.config.project,
+                 **log.mailcontext(self.mail))
 
         commenttext = ""
         commenttext += "From: %s\n\n\n" % self.mail.parsed["From"]
         commenttext += self.mail.textfrombodies()
 
-        comment = self.jira.add_comment(issue, commenttext)     # TODO: error checking
+        comment = self.session.call("add_comment", issue, commenttext)     # TODO: error checking
+
+        self.addattachments(issue)
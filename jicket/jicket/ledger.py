@@ -0,0 +1,80 @@
+"""Ledger of mails that have already been applied to Jira
+
+If jicket stops after a mail has been imported into Jira but before it has been moved out of the inbox, the mail is
+fetched again. The ledger records which steps have been completed for a mail, so they aren't repeated."""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from typing import Dict
+
+from jicket.mailprocessor import ProcessedMail
+
+LEDGER_RETENTION = 30 * 24 * 3600   # Time in seconds for which completed steps are remembered
+COMPACT_INTERVAL = 3600     # Minimum time in seconds between removals of expired entries
+
+STEP_JIRA = "jira"  # Issue has been created or comment has been added
+STEP_THREADSTART = "threadstart"    # Thread starter mail has been sent
+
+
+def mailkey(mail: ProcessedMail) -> str:
+    """Key identifying a mail in the ledger
+
+    This is the Message-ID if the mail has one. Otherwise a hash of the headers and text is used. Mails fetched through
+    a named route are keyed per route, as the same mail may be sent to multiple mailboxes."""
+    if mail.parsed["Message-ID"]:
+        key = str(mail.parsed["Message-ID"]).strip()
+    else:
+        digest = hashlib.sha256(mail.headerbytes)
+        digest.update(mail.textfrombodies().encode("utf-8", errors="replace"))
+        key = "sha256:" + digest.hexdigest()
+    if mail.route:
+        key = "%s:%s" % (mail.route, key)
+    return key
+
+
+class Ledger():
+    """Persistent record of completed processing steps per mail, stored in an SQLite database"""
+    def __init__(self, path: Path, retention: int = LEDGER_RETENTION):
+        self.path = path    # type: Path
+        self.retention = retention  # type: int
+        self.lastcompact = 0.0  # type: float
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS ledger ("
+                            "mailkey TEXT NOT NULL, "
+                            "step TEXT NOT NULL, "
+                            "newissue INTEGER NOT NULL DEFAULT 0, "
+                            "created REAL NOT NULL, "
+                            "PRIMARY KEY (mailkey, step))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS ledger_created ON ledger (created)")
+
+    def steps(self, key: str) -> Dict[str, bool]:
+        """Get the completed steps of a mail
+
+        Returns:
+            Dict of completed steps, with the value indicating whether a new issue was created in that step
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT step, newissue FROM ledger WHERE mailkey = ?", (key,))
+            return {row[0]: bool(row[1]) for row in rows}
+
+    def record(self, key: str, step: str, newissue: bool = False) -> None:
+        """Record that a step has been completed for a mail"""
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO ledger (mailkey, step, newissue, created) VALUES (?, ?, ?, ?)",
+                            (key, step, int(newissue), time.time()))
+
+    def compact(self) -> None:
+        """Remove entries older than the retention time, at most once per COMPACT_INTERVAL"""
+        now = time.time()
+        if now - self.lastcompact < COMPACT_INTERVAL:
+            return
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM ledger WHERE created < ?", (now - self.retention,))
+        self.lastcompact = now
@@ -1,13 +1,158 @@
-"""Helper functions for logging"""
+"""Helper functions for logging
 
-def info(msg: str) -> None:
-    print("\33[1m\33[34mInfo:\33[0m %s" % msg)
+Messages are passed to the standard logging module. Once ``configure`` has been called, records are put into a queue
+and written to stdout by a background thread, so writing the log never blocks the processing of mails. Messages are
+formatted lazily, e.g. ``log.info("%i new email(s) in inbox", count)``, and messages below the configured level are
+dropped before they are formatted.
 
-def success(msg: str) -> None:
-    print("\33[1m\33[32mSuccess:\33[0m %s" % msg)
+Context of a message, like the mail it refers to, is given as keyword arguments, e.g.
+``log.info("Creating new Issue", **log.mailcontext(mail))``. It is appended to text lines and stored as separate fields
+in JSON lines."""
 
-def warning(msg: str) -> None:
-    print("\33[1m\33[33mWarning:\33[0m %s" % msg)
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
 
-def error(msg: str) -> None:
-    print("\33[1m\33[31mError:\33[0m %s" % msg)
+from typing import Dict
+
+SUCCESS = 25
+logging.addLevelName(SUCCESS, "SUCCESS")
+
+# Levels by their name in the configuration
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "success": SUCCESS,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+
+FORMATS = ("text", "json")
+
+COLORS = {
+    logging.DEBUG: "\33[1m\33[37m",
+    logging.INFO: "\33[1m\33[34m",
+    SUCCESS: "\33[1m\33[32m",
+    logging.WARNING: "\33[1m\33[33m",
+    logging.ERROR: "\33[1m\33[31m",
+}
+
+
+class TextFormatter(logging.Formatter):
+    """Colored lines for humans"""
+    def format(self, record: logging.LogRecord) -> str:
+        line = "%s%s:\33[0m %s" % (COLORS.get(record.levelno, ""), record.levelname.capitalize(), record.getMessage())
+        context = getattr(record, "context", None)
+        if context:
+            line += " \33[2m[%s]\33[0m" % " ".join(
+                "%s=%s" % (key, formatvalue(value)) for key, value in context.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log collectors"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "context", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def formatvalue(value) -> str:
+    if isinstance(value, float):
+        return "%.3f" % value
+    return str(value)
+
+
+logger = logging.getLogger("jicket")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+
+# Until the log is configured, messages are written directly
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(TextFormatter())
+logger.addHandler(_handler)
+
+_listener = None    # type: logging.handlers.QueueListener
+
+
+def configure(level: str = "info", fmt: str = "text") -> None:
+    """Set the level and format of the log and move writing it to a background thread
+
+    Args:
+        level: Lowest level that is logged, one of LEVELS
+        fmt: Either "text" or "json"
+    """
+    global _listener
+    if level not in LEVELS:
+        raise Exception("Unknown log level '%s'" % level)
+    if fmt not in FORMATS:
+        raise Exception("Unknown log format '%s'" % fmt)
+
+    shutdown()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+
+    for oldhandler in list(logger.handlers):
+        logger.removeHandler(oldhandler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(LEVELS[level])
+
+
+def shutdown() -> None:
+    """Write all queued messages and stop the background thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
+
+
+def mailcontext(mail) -> Dict[str, object]:
+    """Context of a message concerning a mail"""
+    context = {"uid": mail.uid, "tickethash": mail.prefixedhash}
+    if mail.route:
+        context["route"] = mail.route
+    return context
+
+
+def _log(level: int, msg: str, args: tuple, context: Dict[str, object]) -> None:
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, extra={"context": context})
+
+
+def debug(msg: str, *args, **context) -> None:
+    _log(logging.DEBUG, msg, args, context)
+
+
+def info(msg: str, *args, **context) -> None:
+    _log(logging.INFO, msg, args, context)
+
+
+def success(msg: str, *args, **context) -> None:
+    _log(SUCCESS, msg, args, context)
+
+
+def warning(msg: str, *args, **context) -> None:
+    _log(logging.WARNING, msg, args, context)
+
+
+def error(msg: str, *args, **context) -> None:
+    _log(logging.ERROR, msg, args, context)
@@ -1,10 +1,14 @@
 from jicket.mailhandling import ProcessedMail
+import jicket.log as log
+import jicket.metrics as metrics
 
 import re
 import json
 from pathlib import Path
 
-from typing import Tuple, List
+from typing import Tuple, List, Pattern, Union
+
+SEARCH_KEYS_PER_QUERY = 25  # Number of search keys combined into a single IMAP SEARCH command
 
 
 class FilterRule():
@@ -22,6 +26,17 @@ class FilterRule():
         if "ignorecase" in config:
             self.ignorecase = config["ignorecase"]
 
+        # Compile patterns once, so invalid patterns are detected when loading the config
+        reflags = 0
+        if self.ignorecase:
+            reflags = reflags | re.IGNORECASE
+        self.addressregex: Pattern = None
+        self.subjectregex: Pattern = None
+        if self.addresspattern is not None:
+            self.addressregex = re.compile(self.addresspattern, reflags)
+        if self.subjectpattern is not None:
+            self.subjectregex = re.compile(self.subjectpattern, reflags)
+
     def filtermail(self, mail: ProcessedMail) -> bool:
         """
 
@@ -29,15 +44,33 @@ class FilterRule():
         :return: Returns whether the filter has a positive match
         :rtype: bool
         """
-        reflags = 0
-        if self.ignorecase:
-            reflags = reflags | re.IGNORECASE
-        if self.subjectpattern is not None and re.search(self.subjectpattern, mail.subject, reflags):
+        if self.subjectregex is not None and self.subjectregex.search(mail.subject or ""):
             return True
-        if self.addresspattern is not None and re.search(self.addresspattern, mail.parsed["from"], reflags):
+        if self.addressregex is not None and self.addressregex.search(mail.parsed["from"] or ""):
             return True
         return False
 
+    def searchkeys(self) -> Union[List[str], None]:
+        """IMAP SEARCH keys matching the same mails as this rule
+
+        IMAP SEARCH matches case-insensitive substrings, so this is only possible for case-insensitive rules whose
+        patterns are plain ASCII text.
+
+        Returns:
+            Search keys, any of which matches, or None if the rule can only be applied by jicket itself
+        """
+        if not self.ignorecase:
+            return None
+        keys = []
+        for key, regex in (("FROM", self.addressregex), ("SUBJECT", self.subjectregex)):
+            if regex is None:
+                continue
+            text = literalpattern(regex)
+            if not text or not all(" " <= c <= "~" and c not in "\\\"" for c in text):
+                return None
+            keys.append('%s "%s"' % (key, text))
+        return keys or None
+
 
 class BlacklistFilterRule(FilterRule):
     pass
@@ -47,30 +80,198 @@ class WhitelistFilterRule(FilterRule):
     pass
 
 
+def literalpattern(regex: Pattern) -> Union[str, None]:
+    """Get the text matched by a regex that consists of nothing but (escaped) literal characters
+
+    Returns:
+        Text matched by the regex, or None if the regex uses any other syntax
+    """
+    text = []
+    escaped = False
+    for c in regex.pattern:
+        if escaped:
+            if c.isalnum():
+                return None     # Special sequence like \d or \b
+            text.append(c)
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c in ".^$*+?{}[]|()":
+            return None
+        else:
+            text.append(c)
+    if escaped:
+        return None
+    return "".join(text)
+
+
+def searchqueries(rules: List[FilterRule]) -> Union[List[str], None]:
+    """Combine the search keys of rules into IMAP SEARCH criteria matching if any of the rules matches
+
+    Returns:
+        Criteria, each combining up to SEARCH_KEYS_PER_QUERY keys, or None if any rule can't be searched for
+    """
+    keys = []
+    for rule in rules:
+        rulekeys = rule.searchkeys()
+        if rulekeys is None:
+            return None
+        keys.extend(rulekeys)
+
+    queries = []
+    for i in range(0, len(keys), SEARCH_KEYS_PER_QUERY):
+        chunk = keys[i:i + SEARCH_KEYS_PER_QUERY]
+        query = chunk[-1]
+        for key in reversed(chunk[:-1]):
+            query = "OR %s %s" % (key, query)
+        queries.append(query)
+    return queries
+
+
+def combinable(regex: Pattern) -> bool:
+    """Whether a pattern keeps its meaning when it is embedded into a larger regex"""
+    if re.search(r"\\[1-9]|\(\?P=|\(\?\(\d+\)", regex.pattern):
+        return False    # Backreferences and conditional group references would refer to the wrong group
+    try:
+        re.compile("(?:%s)" % regex.pattern)
+    except re.error:
+        return False    # e.g. global inline flags like (?i) that are only allowed at the start
+    return True
+
+
+def combineregexes(regexes: List[Pattern]) -> Pattern:
+    """Combine regexes into a single regex matching if any of them matches
+
+    Returns:
+        Combined regex, or None if the regexes couldn't be combined
+    """
+    parts = []
+    for regex in regexes:
+        if regex.flags & re.IGNORECASE:
+            parts.append("(?i:%s)" % regex.pattern)
+        else:
+            parts.append("(?:%s)" % regex.pattern)
+    try:
+        return re.compile("|".join(parts))
+    except re.error:
+        return None     # e.g. the same group name is used in multiple patterns
+
+
+class RuleMatcher():
+    """Matches a mail against a list of rules at once
+
+    The patterns of all rules are combined into a single regex per field. Most mails don't match any rule, which is
+    then decided with one regex search per field, regardless of the number of rules. Only if a combined regex matches,
+    the rules are checked individually to find out which of them matched."""
+    def __init__(self, rules: List[FilterRule]):
+        self.rules = rules  # type: List[FilterRule]
+
+        self.subjectregex: Pattern = None
+        self.addressregex: Pattern = None
+        self.uncombined: List[FilterRule] = []  # Rules that need to be checked individually for every mail
+
+        subjectregexes = []
+        addressregexes = []
+        for rule in rules:
+            regexes = [r for r in (rule.subjectregex, rule.addressregex) if r is not None]
+            if not all(combinable(r) for r in regexes):
+                self.uncombined.append(rule)
+                continue
+            if rule.subjectregex is not None:
+                subjectregexes.append(rule.subjectregex)
+            if rule.addressregex is not None:
+                addressregexes.append(rule.addressregex)
+
+        if subjectregexes:
+            self.subjectregex = combineregexes(subjectregexes)
+        if addressregexes:
+            self.addressregex = combineregexes(addressregexes)
+        if (subjectregexes and self.subjectregex is None) or (addressregexes and self.addressregex is None):
+            self.subjectregex = None
+            self.addressregex = None
+            self.uncombined = list(rules)
+
+    def match(self, mail: ProcessedMail) -> List[FilterRule]:
+        """Get all rules matching the mail"""
+        if self.subjectregex is not None and self.subjectregex.search(mail.subject or ""):
+            return [rule for rule in self.rules if rule.filtermail(mail)]
+        if self.addressregex is not None and self.addressregex.search(mail.parsed["from"] or ""):
+            return [rule for rule in self.rules if rule.filtermail(mail)]
+        return [rule for rule in self.uncombined if rule.filtermail(mail)]
+
+
 class MailFilter():
     def __init__(self, filterpath: Path):
-        with filterpath.open("r") as f:
+        self.filterpath = filterpath    # type: Path
+        self.mtime = None   # type: float   # Modification time of config file when it was last loaded
+
+        self.load()
+
+    def load(self) -> None:
+        """Load the filter config and replace the current rules with it"""
+        mtime = self.filterpath.stat().st_mtime
+        with self.filterpath.open("r") as f:
             config = json.load(f)
 
-        self.blacklist = []
+        blacklist = []
         for blconfig in config["blacklist"]:
-            self.blacklist.append(BlacklistFilterRule(blconfig))
+            blacklist.append(BlacklistFilterRule(blconfig))
 
-        self.whitelist = []
+        whitelist = []
         for wlconfig in config["whitelist"]:
-            self.whitelist.append(WhitelistFilterRule(wlconfig))
+            whitelist.append(WhitelistFilterRule(wlconfig))
+
+        # Blacklist rules the IMAP server can evaluate. The server can only filter mails if it can also apply the
+        # whitelist, as the whitelist can't be applied to mails that aren't fetched.
+        whitelistqueries = searchqueries(whitelist)
+        searchable = [rule for rule in blacklist if rule.searchkeys() is not None]
+        blacklistqueries = searchqueries(searchable) if whitelistqueries is not None else []
+
+        # Only replace the rules once the new config has been loaded completely
+        self.blacklist, self.whitelist = blacklist, whitelist
+        self.blacklistmatcher, self.whitelistmatcher = RuleMatcher(blacklist), RuleMatcher(whitelist)
+        self.blacklistqueries, self.whitelistqueries = blacklistqueries, whitelistqueries or []
+        self.mtime = mtime
+
+        if blacklistqueries:
+            log.info("%i of %i blacklist rule(s) are applied by the IMAP server", len(searchable), len(blacklist))
+
+    def reload_if_changed(self) -> bool:
+        """Reload the filter config if the file has been modified since it was loaded
+
+        If the modified config is invalid, the current rules are kept.
+
+        Returns:
+            Whether new rules have been loaded
+        """
+        try:
+            mtime = self.filterpath.stat().st_mtime
+        except OSError as e:
+            log.warning("Can't access filter config, keeping current rules: %s", e)
+            return False
+        if mtime == self.mtime:
+            return False
+
+        try:
+            self.load()
+        except (OSError, ValueError, KeyError, TypeError, re.error) as e:
+            log.error("Filter config '%s' is invalid, keeping current rules: %s", self.filterpath, e)
+            self.mtime = mtime  # Don't try again until the file is modified again
+            return False
+
+        log.success("Reloaded filter config '%s'", self.filterpath)
+        return True
 
     def filtermail(self, mail: ProcessedMail) -> Tuple[bool, List[str]]:
         filtered: bool = False
         description: List[str] = []
-        for blacklistfilter in self.blacklist:
-            if blacklistfilter.filtermail(mail):
+        with metrics.timed("filter"):
+            for blacklistfilter in self.blacklistmatcher.match(mail):
                 filtered = True
                 description.append("BLACKLISTED: %s" % blacklistfilter.description)
 
-        if filtered:
-            for whitelistfilter in self.whitelist:
-                if whitelistfilter.filtermail(mail):
+            if filtered:
+                for whitelistfilter in self.whitelistmatcher.match(mail):
                     filtered = False
                     description.append("WHITELISTED: %s" % whitelistfilter.description)
 
@@ -3,11 +3,15 @@
 Reads all emails from a mailbox with IMAP. After the emails are parsed by jicket they will be further processed
 (moved to folders for example) based on success or fail."""
 
-from typing import Union, List
+from typing import Union, List, Set, Dict, Iterable, Iterator, Tuple
 import imaplib
+import select
 import smtplib
 import ssl
+import threading
+import time
 import jicket.log as log
+import jicket.metrics as metrics
 import email.parser
 import email.mime.text
 import email.headerregistry
@@ -16,10 +20,79 @@ import hashids
 import re
 from jicket.mailprocessor import ProcessedMail
 from jicket.config import MailConfig
+from jicket.templates import ThreadTemplates, THREADSTART_POLICY
 
 from pathlib import Path
 
 
+# Headers needed to decide on threadstarters, filtering, ticket IDs and thread template language before downloading
+# the full mail. Headers of header-only mails are not parsed again when the body is loaded.
+HEADER_FIELDS = ["FROM", "TO", "CC", "SUBJECT", "MESSAGE-ID", "IN-REPLY-TO", "X-JICKET-HASHID",
+                 "X-JICKET-INITIAL-REPLYID", "CONTENT-LANGUAGE", "ACCEPT-LANGUAGE"]
+
+FETCH_BATCH_BYTES = 10 * 1024 * 1024    # Maximum total size of complete mails fetched with a single IMAP command
+MOVE_BATCH_SIZE = 500   # Maximum number of mails moved with a single IMAP command
+SEARCH_BATCH_SIZE = 500     # Maximum number of UIDs a single IMAP SEARCH is restricted to
+SMTP_NOOP_INTERVAL = 30     # Idle time in seconds after which an SMTP session is checked with NOOP before reuse
+
+
+def uidset(uids: Iterable[int]) -> bytes:
+    """Build a compact IMAP sequence set (e.g. 1:4,7) from a list of UIDs"""
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join("%i:%i" % (r[0], r[1]) if r[0] != r[1] else "%i" % r[0] for r in ranges).encode()
+
+
+def sizebatches(mails: List[ProcessedMail], maxcount: int, maxbytes: int = FETCH_BATCH_BYTES) -> List[List[int]]:
+    """Split mails into batches of UIDs with at most maxcount mails and maxbytes bytes in total
+
+    Mails larger than maxbytes, or whose size is unknown, get a batch of their own."""
+    batches = []    # type: List[List[int]]
+    batchbytes = 0
+    for mail in mails:
+        size = mail.size if mail.size is not None else maxbytes
+        if not batches or len(batches[-1]) >= maxcount or batchbytes + size > maxbytes:
+            batches.append([])
+            batchbytes = 0
+        batches[-1].append(mail.uid)
+        batchbytes += size
+    return batches
+
+
+def parse_fetch_response(data: list) -> List[Tuple[int, bytes, bytes]]:
+    """Split the data of a FETCH response into individual messages
+
+    imaplib returns every message containing a literal as tuple (prefix, literal), followed by the rest of the
+    response line. Depending on the server, data items like UID can be located before or after the literal.
+
+    Returns:
+        List of tuples (uid, metadata, literal) where metadata contains all non-literal parts of the response
+    """
+    messages = []   # type: List[List[bytes]]
+    trailer = False
+    for item in data:
+        if isinstance(item, tuple):
+            messages.append([item[0], item[1]])
+            trailer = True
+        elif trailer and item:
+            # Rest of the response line after the literal. Unrelated responses (e.g. flag updates) are ignored.
+            messages[-1][0] += item
+            trailer = False
+
+    parsed = []
+    for metadata, literal in messages:
+        match = re.search(rb"UID (\d+)", metadata)
+        if match is None:
+            log.warning("Ignoring FETCH response without UID: %s", metadata.decode(errors="replace"))
+            continue
+        parsed.append((int(match.group(1)), metadata, literal))
+    return parsed
+
+
 def decodeheader(header: str) -> str:
     decoded = ""
 
@@ -40,19 +113,30 @@ class MailImporter():
         self.mailconfig = mailconfig    # type: MailConfig
         self.IMAP = None    # type: Union[imaplib.IMAP4, imaplib.IMAP4_SSL]
 
+        self.uidvalidity = None     # type: int   # UIDVALIDITY of inbox at last search
+        self.uidnext = None     # type: int   # Lowest UID that hasn't been searched for yet
+        self.pendinguids = set()    # type: Set[int]   # Listed UIDs that haven't been moved out of the inbox yet
+        self.moveuids = set()   # type: Set[int]   # UIDs to be moved to success folder on next commit_moves
+
         # Perform some validity checks
         self.login()
         self.checkFolders()
 
     def login(self):
         """Connects to the mailbox and logs in."""
-        self.IMAP = imaplib.IMAP4_SSL(self.mailconfig.IMAPHost, 993, ssl_context=ssl.create_default_context())
+        self.IMAP = imaplib.IMAP4_SSL(self.mailconfig.IMAPHost, self.mailconfig.IMAPPort,
+                                      ssl_context=ssl.create_default_context())
         try:
             self.IMAP.login(self.mailconfig.IMAPUser, self.mailconfig.IMAPPass)
         except:
             log.error("IMAP login failed. Are your login credentials correct?")
             raise
 
+        # Servers often only announce extensions like MOVE after authentication
+        response = self.IMAP.capability()
+        if response[0] == "OK":
+            self.IMAP.capabilities = tuple(response[1][-1].decode().upper().split())
+
     def logout(self):
         """Logs out of the mailbox and closes the connection."""
         pass
@@ -62,65 +146,314 @@ class MailImporter():
         log.info("Checking if configured folders exist")
         response = self.IMAP.select(self.mailconfig.folderInbox)
         if response[0] != "OK":
-            log.error("Error accessing Folder '%s': %s" % (self.mailconfig.folderInbox, response[1][0].decode()))
+            log.error("Error accessing Folder '%s': %s", self.mailconfig.folderInbox, response[1][0].decode())
             # TODO: Raise exception
         response = self.IMAP.select(self.mailconfig.folderSuccess)
         if response[0] != "OK":
-            log.error("Error accessing Folder '%s': %s" % (self.mailconfig.folderSuccess, response[1][0].decode()))
+            log.error("Error accessing Folder '%s': %s", self.mailconfig.folderSuccess, response[1][0].decode())
             # TODO: Raise exception
 
     def get_mail_list(self) -> List[int]:
         """Get list of all mail-UIDs that are in the inbox
 
+        Only mails that arrived since the last call are searched for on the server. Mails that were listed before but
+        haven't been moved yet are returned again, so that mails which failed processing are retried. A full resync
+        is only done on the first call or when the UIDVALIDITY of the inbox changes.
+
         Returns:
             List of UIDs of mails in inbox
         """
         response = self.IMAP.select(self.mailconfig.folderInbox)
         if response[0] != "OK":
-            log.error("Error accessing Folder '%s': %s" % (self.mailconfig.folderInbox, response[1][0].decode()))
+            log.error("Error accessing Folder '%s': %s", self.mailconfig.folderInbox, response[1][0].decode())
+            return []
         emailcount: int = int(response[1][0])
+        uidvalidity: int = self._response_int("UIDVALIDITY")
+        uidnext: int = self._response_int("UIDNEXT")
         if not emailcount > 0:
+            self.pendinguids.clear()
+            self.uidvalidity = uidvalidity
+            self.uidnext = uidnext
             return []
-        log.info("%s email(s) in inbox" % emailcount)
 
-        response = self.IMAP.uid("search", None, "(ALL)")
+        if uidvalidity is None or uidvalidity != self.uidvalidity or self.uidnext is None:
+            if self.uidvalidity is not None and uidvalidity != self.uidvalidity:
+                log.warning("UIDVALIDITY of inbox changed, resynchronizing")
+            lowestuid = 1
+        elif len(self.pendinguids) > emailcount:
+            # Mails were removed from the inbox by someone else
+            lowestuid = 1
+        elif uidnext is not None and uidnext == self.uidnext:
+            # Nothing new arrived since the last search
+            return sorted(self.pendinguids)
+        else:
+            lowestuid = self.uidnext
+
+        with metrics.timed("imap_search"):
+            if lowestuid == 1:
+                response = self.IMAP.uid("search", None, "(ALL)")
+            else:
+                response = self.IMAP.uid("search", None, "(UID %i:*)" % lowestuid)
         if response[0] != "OK":
-            log.error("Failed to retrieve mails from inbox: %s" % response[1][0].decode())
-            return []
+            log.error("Failed to retrieve mails from inbox: %s", response[1][0].decode())
+            return sorted(self.pendinguids)
             # TODO: Raise exception?
         indices: List[bytes] = response[1][0].split()
-        return [int(x) for x in indices]
+        # "n:*" always contains the highest UID in the mailbox, even if it is lower than n
+        newuids = [int(x) for x in indices if int(x) >= lowestuid]
+
+        if lowestuid == 1:
+            self.pendinguids.clear()
+        self.pendinguids.update(newuids)
+        self.uidvalidity = uidvalidity
+        if uidnext is not None:
+            self.uidnext = uidnext
+        elif self.pendinguids:
+            self.uidnext = max(self.pendinguids) + 1
+
+        if newuids:
+            log.info("%s new email(s) in inbox", len(newuids))
+        return sorted(self.pendinguids)
+
+    def _response_int(self, code: str) -> Union[int, None]:
+        """Get integer value of a response code (e.g. UIDNEXT) from the last command, if the server sent one"""
+        data = self.IMAP.response(code)[1][-1]
+        if data is None:
+            return None
+        return int(data)
 
-    def fetchMail(self, uid: int) -> ProcessedMail:
-        """Fetch mail with uid from inbox
+    def fetch_many(self, uids: List[int], chunk_size: int = None, headeronly: bool = False) -> Iterator[ProcessedMail]:
+        """Fetch mails in batches, with one FETCH command per batch
 
         Arguments:
-            uid: uid of email to fetch
+            uids: uids of emails to fetch
+            chunk_size: Number of mails fetched per command. Defaults to MailConfig.fetchBatchSize.
+            headeronly: Only fetch the headers listed in HEADER_FIELDS and the mail size. The body can be fetched
+                        later with fetch_bodies.
 
         Returns:
-            Email with uid, or None if it couldn't be found
+            Iterator over the fetched mails, in order of the responses. Mails that couldn't be found are skipped.
         """
-        uidbytes: bytes = str(uid).encode()
+        if headeronly:
+            query = "(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (%s)])" % " ".join(HEADER_FIELDS)
+        else:
+            query = "(UID RFC822)"
 
-        response = self.IMAP.uid("fetch", uidbytes, "(RFC822)")
-        if response[0] != "OK":
-            log.error("Failed to fetch mail: %s" % response[1][0].decode())
-            # TODO: throw exception?
-            return None
+        for uid, metadata, literal in self._fetch_chunked(uids, query, chunk_size):
+            if headeronly:
+                match = re.search(rb"RFC822\.SIZE (\d+)", metadata)
+                size = int(match.group(1)) if match else None
+                yield ProcessedMail(uid, literal, self.mailconfig, headeronly=True, size=size)
+            else:
+                yield ProcessedMail(uid, literal, self.mailconfig)
+
+    def fetch_bodies(self, mails: List[ProcessedMail], chunk_size: int = None) -> Iterator[ProcessedMail]:
+        """Fetch the full content of mails that were fetched header-only
 
-        return ProcessedMail(uid, response[1][0][1], self.mailconfig)
+        Besides chunk_size, batches are limited to FETCH_BATCH_BYTES by the sizes known from the header pass, so that
+        large mails are fetched one at a time.
+
+        Returns:
+            Iterator over the completed mails. Mails that couldn't be found anymore are skipped.
+        """
+        if chunk_size is None:
+            chunk_size = self.mailconfig.fetchBatchSize
+
+        mailsbyuid = {mail.uid: mail for mail in mails}
+        for uid, metadata, literal in self._fetch_batches(sizebatches(mails, chunk_size, FETCH_BATCH_BYTES),
+                                                         "(UID RFC822)"):
+            mail = mailsbyuid.get(uid)
+            if mail is None:
+                continue
+            mail.load_body(literal)
+            del literal     # Not kept alive while the mail is processed
+            yield mail
+
+    def _fetch_chunked(self, uids: List[int], query: str, chunk_size: int = None) -> Iterator[Tuple[int, bytes, bytes]]:
+        """Issue a UID FETCH for uids in batches of chunk_size and yield the individual messages"""
+        if chunk_size is None:
+            chunk_size = self.mailconfig.fetchBatchSize
+        return self._fetch_batches([uids[i:i + chunk_size] for i in range(0, len(uids), chunk_size)], query)
+
+    def _fetch_batches(self, batches: List[List[int]], query: str) -> Iterator[Tuple[int, bytes, bytes]]:
+        """Issue a UID FETCH for every batch of uids and yield the individual messages"""
+        for chunk in batches:
+            with metrics.timed("imap_fetch"):
+                response = self.IMAP.uid("fetch", uidset(chunk), query)
+            if response[0] != "OK":
+                log.error("Failed to fetch mails: %s", response[1][0].decode())
+                continue
+
+            # Hand out the messages one by one without keeping the whole response, so every message can be freed as
+            # soon as it has been processed
+            messages = parse_fetch_response(response[1])
+            del response
+            messages.reverse()
+            fetched = set()
+            while messages:
+                message = messages.pop()
+                fetched.add(message[0])
+                metrics.count("jicket_mails_fetched_total")
+                metrics.count("jicket_fetched_bytes_total", len(message[2] or b""))
+                yield message
+                del message
+
+            # Mails that have been removed from the inbox in the meantime
+            self.pendinguids.difference_update(set(chunk) - fetched)
+
+    def search(self, criteria: str, uids: List[int]) -> Union[Set[int], None]:
+        """Search the inbox for mails matching IMAP SEARCH criteria, among the given UIDs
+
+        Returns:
+            UIDs of matching mails, or None if the search failed
+        """
+        matches = set()
+        uids = sorted(uids)
+        for i in range(0, len(uids), SEARCH_BATCH_SIZE):
+            chunk = uids[i:i + SEARCH_BATCH_SIZE]
+            with metrics.timed("imap_search"):
+                response = self.IMAP.uid("search", None, "UID", uidset(chunk), criteria)
+            if response[0] != "OK":
+                log.warning("IMAP search failed: %s", response[1][0].decode())
+                return None
+            matches.update(int(x) for x in response[1][0].split())
+        return matches
+
+    def supports_idle(self) -> bool:
+        """Whether the IMAP server supports the IDLE extension (RFC 2177)"""
+        return "IDLE" in self.IMAP.capabilities
+
+    def idle(self, timeout: float) -> bool:
+        """Wait in IMAP IDLE until the server announces new mail or the timeout is reached
+
+        imaplib has no support for IDLE, so the command is issued manually on the underlying connection. Untagged
+        responses other than EXISTS (e.g. flag changes or keepalives) are consumed without ending the IDLE.
+
+        Arguments:
+            timeout: Maximum time in seconds to stay in IDLE. Should be well below 29 minutes, after which servers
+                     are allowed to drop the connection.
+
+        Returns:
+            Whether the server reported new mail in the inbox
+        """
+        response = self.IMAP.select(self.mailconfig.folderInbox)
+        if response[0] != "OK":
+            log.error("Error accessing Folder '%s': %s", self.mailconfig.folderInbox, response[1][0].decode())
+            return False
+        self.IMAP.untagged_responses.pop("EXISTS", None)
+
+        # Mail that arrived since the inbox was last listed is only counted by SELECT and never announced in IDLE
+        uidnext = self._response_int("UIDNEXT")
+        if self.uidnext is None:
+            return True
+        if uidnext is not None and uidnext != self.uidnext:
+            return True
+        if uidnext is None and int(response[1][0]) > len(self.pendinguids):
+            return True
+
+        tag = self.IMAP._new_tag()
+        self.IMAP.send(tag + b" IDLE\r\n")
+
+        # Wait for continuation response. A tagged response at this point means the server refused IDLE.
+        while self.IMAP._get_response() is not None:
+            if self.IMAP.tagged_commands[tag] is not None:
+                typ, data = self.IMAP.tagged_commands.pop(tag)
+                log.error("IMAP IDLE was refused by server: %s %s", typ, data[0].decode())
+                return False
+
+        deadline = time.time() + timeout
+        sock = self.IMAP.sock
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if self._buffered() or select.select([sock], [], [], remaining)[0]:
+                self.IMAP._get_response()
+                if "EXISTS" in self.IMAP.untagged_responses:
+                    break
+
+        self.IMAP.send(b"DONE\r\n")
+        self.IMAP._command_complete("IDLE", tag)
+
+        return self.IMAP.untagged_responses.pop("EXISTS", None) is not None
+
+    def _buffered(self) -> bool:
+        """Whether data has already been received that select() can't see
+
+        imaplib reads the connection through a buffered file, so a response that arrived in the same packet as the
+        previous one can already be waiting in its buffer. With SSL, data can also be waiting decrypted in the SSL
+        buffer. Both are checked by peeking into the file without blocking."""
+        sock = self.IMAP.sock
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            return bool(self.IMAP.file.peek(1))
+        except OSError:
+            return False    # Nothing buffered, e.g. SSLWantReadError
+        finally:
+            sock.settimeout(timeout)
 
     def moveImported(self, mail):
-        """Move successfully imported mails to success folder"""
-        self.IMAP.uid("copy", str(mail.uid).encode(), self.mailconfig.folderSuccess)
-        self.IMAP.uid("store", str(mail.uid).encode(), "+flags", "(\Deleted)")
-        self.IMAP.expunge()
+        """Mark successfully imported mails to be moved to success folder
+
+        Mails are only moved on the server once commit_moves is called."""
+        self.moveuids.add(mail.uid)
+
+    def commit_moves(self) -> bool:
+        """Move all mails marked with moveImported to the success folder
+
+        Uses UID MOVE (RFC 6851) if available. Otherwise the mails are copied and flagged as deleted, followed by a
+        UID EXPUNGE (RFC 4315) if available, or a regular EXPUNGE.
+
+        Returns:
+            Whether all mails have been moved successfully
+        """
+        uids = sorted(self.moveuids)
+        success = True
+        for i in range(0, len(uids), MOVE_BATCH_SIZE):
+            chunk = uids[i:i + MOVE_BATCH_SIZE]
+            with metrics.timed("imap_move"):
+                moved = self._move(uidset(chunk))
+            if moved:
+                metrics.count("jicket_mails_moved_total", len(chunk))
+                self.moveuids.difference_update(chunk)
+                self.pendinguids.difference_update(chunk)
+            else:
+                success = False
+        return success
+
+    def _move(self, uids: bytes) -> bool:
+        """Move mails in UID set to the success folder"""
+        if "MOVE" in self.IMAP.capabilities:
+            response = self.IMAP.uid("move", uids, self.mailconfig.folderSuccess)
+            if response[0] != "OK":
+                log.error("Failed to move mails: %s", response[1][0].decode())
+                return False
+            return True
+
+        response = self.IMAP.uid("copy", uids, self.mailconfig.folderSuccess)
+        if response[0] != "OK":
+            log.error("Failed to copy mails: %s", response[1][0].decode())
+            return False
+        self.IMAP.uid("store", uids, "+flags", "(\Deleted)")
+        if "UIDPLUS" in self.IMAP.capabilities:
+            self.IMAP.uid("expunge", uids)
+        else:
+            self.IMAP.expunge()
+        return True
 
 
 class MailExporter():
-    """Sends out mails via SMTP"""
+    """Sends out mails via SMTP
+
+    The SMTP session is kept open between mails and reused as long as it is alive and hasn't been idle for longer
+    than MailConfig.SMTPIdleTimeout."""
     def __init__(self, mailconfig: MailConfig):
         self.mailconfig = mailconfig    # type: MailConfig
+        self.SMTP = None    # type: smtplib.SMTP
+        self.lastused = 0.0     # type: float   # Time of last successful command
+        self.lock = threading.Lock()    # Sending is not thread safe
+        self.templates = {}     # type: Dict[Path, ThreadTemplates]   # Loaded thread templates by path
 
     def login(self):
         self.SMTP = smtplib.SMTP(self.mailconfig.SMTPHost, self.mailconfig.SMTPPort)
@@ -132,9 +465,35 @@ class MailExporter():
         except smtplib.SMTPAuthenticationError:
             log.error("SMTP login failed. Are your login credentials correct?")
             raise
+        self.lastused = time.time()
 
     def quit(self):
-        self.SMTP.quit()
+        if self.SMTP is None:
+            return
+        try:
+            self.SMTP.quit()
+        except (smtplib.SMTPException, OSError):
+            pass    # Connection is dropped either way
+        self.SMTP = None
+
+    def connect(self):
+        """Make sure an authenticated SMTP session is available, reusing the existing one if it is still alive"""
+        if self.SMTP is not None:
+            idletime = time.time() - self.lastused
+            if idletime > self.mailconfig.SMTPIdleTimeout:
+                self.quit()
+            elif idletime < SMTP_NOOP_INTERVAL:
+                return  # Recently used, a dropped connection is handled when sending
+            else:
+                try:
+                    if self.SMTP.noop()[0] == 250:
+                        self.lastused = time.time()
+                        return
+                except (smtplib.SMTPException, OSError):
+                    pass
+                log.info("SMTP connection was closed, reconnecting")
+                self.quit()
+        self.login()
 
     def sendmail(self, mail: email.message.Message):
         recipients = []
@@ -143,19 +502,41 @@ class MailExporter():
         if mail["cc"] is not None:
             for addr in mail["cc"].addresses:
                 recipients.append(str(addr))
-        self.SMTP.sendmail(str(mail["From"]), recipients, mail.as_string())
+
+        with self.lock, metrics.timed("smtp_send"):
+            self.connect()
+            try:
+                self.SMTP.sendmail(str(mail["From"]), recipients, mail.as_string())
+            except smtplib.SMTPServerDisconnected:
+                log.info("SMTP connection was closed, reconnecting")
+                self.SMTP = None
+                self.login()
+                self.SMTP.sendmail(str(mail["From"]), recipients, mail.as_string())
+            self.lastused = time.time()
+
+    def load_templates(self, path: Path) -> ThreadTemplates:
+        """Load the thread templates at path, unless they have been loaded already
+
+        Raises an exception if a template is invalid, so this should be called on startup."""
+        if path not in self.templates:
+            self.templates[path] = ThreadTemplates(path)
+        return self.templates[path]
+
+    def reload_templates(self) -> None:
+        """Reload all thread templates that have been modified"""
+        for templates in self.templates.values():
+            templates.reload_if_changed()
 
     def sendTicketStart(self, mail: ProcessedMail):
-        """Sends the initial mail to start an email thread from an incoming email"""
+        """Sends the initial mail to start an email thread from an incoming email
+
+        Template, ticket address and ID prefix are taken from the config the mail was fetched with, so one exporter
+        can send thread starters for multiple mailboxes."""
+        config = mail.config    # type: MailConfig
 
-        with self.mailconfig.threadStartTemplate.open("r") as f:
-            responsehtml = f.read()
-            responsehtml = responsehtml % {
-                "ticketid": mail.tickethash,
-                "subject": mail.subject
-            }
+        responsehtml = self.load_templates(config.threadStartTemplate).render(mail)
 
-        threadstarter = email.mime.text.MIMEText(responsehtml, "html", policy=email.policy.EmailPolicy(max_line_length=78))
+        threadstarter = email.mime.text.MIMEText(responsehtml, "html", policy=THREADSTART_POLICY)
 
         # Add Jicket headers
         threadstarter["X-Jicket-HashID"] = mail.tickethash
@@ -164,12 +545,13 @@ class MailExporter():
         threadstarter["X-Jicket-Initial-ReplyID"] = mail.parsed["Message-ID"]
 
         # Set other headers
-        threadstarter["to"] = mail.parsed["from"] + ", " + self.mailconfig.ticketAddress
+        threadstarter["to"] = mail.parsed["from"] + ", " + config.ticketAddress
         if mail.parsed["CC"] is not None:
             threadstarter["cc"] = str(mail.parsed["CC"])
-        threadstarter["From"] = self.mailconfig.ticketAddress
+        threadstarter["From"] = config.ticketAddress
         threadstarter["In-Reply-To"] = mail.parsed["Message-ID"]
-        threadstarter["Subject"] = "[#%s%s] %s" % (self.mailconfig.idPrefix, mail.tickethash, mail.subject)
+        threadstarter["Subject"] = "[#%s%s] %s" % (config.idPrefix, mail.tickethash, mail.subject)
 
         # Send mail
         self.sendmail(threadstarter)
+        metrics.count("jicket_threadstarters_total", direction="sent")
@@ -1,39 +1,175 @@
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Iterator
 import imaplib
 import smtplib
 import ssl
 import jicket.log as log
+import jicket.metrics as metrics
 import email.parser
 import email.mime.text
 import email.headerregistry
 import email.policy
-import hashids
 import re
+import base64
+import binascii
+import hashlib
+import tempfile
+from pathlib import Path
 from jicket.config import MailConfig
+import jicket.ticketid as ticketid
 
 import html2text
 
+TRUNCATION_NOTE = "\n\n[...] (Text has been truncated by Jicket)"
+HTML_LENGTH_FACTOR = 10     # HTML is truncated to this multiple of the maximum text length before conversion
+SPOOL_CHUNK_SIZE = 1024 * 1024  # Number of base64 characters decoded at once when spooling attachments
+NON_BASE64 = re.compile("[^A-Za-z0-9+/=]")  # Characters that base64 decoding discards
+
+
+def splitheader(rawmailcontent: bytes) -> bytes:
+    """Get the header section of a raw email, including the empty line separating it from the body"""
+    ends = [rawmailcontent.find(separator) + len(separator) for separator in (b"\r\n\r\n", b"\n\n")
+            if separator in rawmailcontent]
+    if not ends:
+        return rawmailcontent
+    return rawmailcontent[:min(ends)]
+
+
+def decodetextpart(part: email.message.Message, limit: int = None) -> str:
+    """Decode the payload of a text part to a string
+
+    Arguments:
+        part: Non-multipart text part
+        limit: Maximum number of bytes to decode. Base64 payloads are only decoded up to that point.
+    """
+    payload = None
+    if limit is not None and part.get("Content-Transfer-Encoding", "").strip().lower() == "base64":
+        # 4 base64 characters encode 3 bytes, with some headroom for line breaks
+        encoded = "".join(part.get_payload()[:limit * 2].split())
+        try:
+            payload = base64.b64decode(encoded[:len(encoded) - len(encoded) % 4])
+        except binascii.Error:
+            payload = None
+    if payload is None:
+        payload = part.get_payload(decode=True)
+    if limit is not None:
+        payload = payload[:limit]
+
+    # If no charset is provided, assume UTF-8 as per RFC 6657
+    charset = part.get_content_charset() or "utf-8"
+    try:
+        return payload.decode(charset, errors="replace")
+    except LookupError:
+        return payload.decode("utf-8", errors="replace")
+
+
+class Attachment():
+    """Attachment of an email, stored in a temporary file"""
+    def __init__(self, filename: str, path: Path, size: int, sha256: str):
+        self.filename = filename    # type: str
+        self.path = path    # type: Path   # Temporary file containing the decoded attachment
+        self.size = size    # type: int
+        self.sha256 = sha256    # type: str   # Hex digest of content, used to avoid duplicate uploads
+
+    @classmethod
+    def spool(cls, part: email.message.Message, filename: str, limit: int) -> Union["Attachment", None]:
+        """Decode an attachment part into a temporary file
+
+        Base64 payloads are decoded in chunks, so there is never more than one chunk of decoded data in memory.
+
+        Returns:
+            The spooled attachment, or None if it is larger than limit bytes
+
+        Raises:
+            binascii.Error: The payload is not valid base64. The temporary file has been deleted.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        f = tempfile.NamedTemporaryFile(prefix="jicket-", delete=False)
+        path = Path(f.name)
+        try:
+            with f:
+                for chunk in iterdecodedpayload(part):
+                    size += len(chunk)
+                    if size > limit:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+        except binascii.Error:
+            path.unlink()
+            raise
+
+        if size > limit:
+            path.unlink()
+            return None
+        return cls(filename, path, size, digest.hexdigest())
+
+    def delete(self) -> None:
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def iterdecodedpayload(part: email.message.Message) -> Iterator[bytes]:
+    """Decode the payload of a non-multipart part in chunks"""
+    if part.get("Content-Transfer-Encoding", "").strip().lower() != "base64":
+        payload = part.get_payload(decode=True)
+        if payload:
+            yield payload
+        return
+
+    encoded = part.get_payload()
+    remainder = ""
+    for i in range(0, len(encoded), SPOOL_CHUNK_SIZE):
+        # Strip everything that isn't part of the alphabet first, so the groups of 4 line up like when decoding at once
+        chunk = remainder + NON_BASE64.sub("", encoded[i:i + SPOOL_CHUNK_SIZE])
+        cut = len(chunk) - len(chunk) % 4
+        remainder = chunk[cut:]
+        if cut:
+            yield base64.b64decode(chunk[:cut])
+    if remainder.rstrip("="):
+        # Incomplete trailing group, e.g. from a truncated mail. Decode as much as possible.
+        try:
+            decoded = base64.b64decode(remainder + "=" * (-len(remainder) % 4))
+        except binascii.Error:
+            return  # Not enough data left for a single byte
+        yield decoded
+
+
 class ProcessedMail():
-    def __init__(self, uid: int, rawmailcontent: bytes, config: MailConfig):
+    def __init__(self, uid: int, rawmailcontent: bytes, config: MailConfig, headeronly: bool = False,
+                 size: int = None):
         self.uid: int = uid     # Email UID from mailbox. See RFC3501 2.3.1.1.
         self.rawmailcontent: bytes = rawmailcontent     # Email as it comes from IMAP server
         self.config = config
+        self.headeronly: bool = headeronly  # Whether only the headers have been fetched so far
+        self.size: int = size   # Size of the complete email in bytes, if known
 
-        self.parsed: email.message.Message = None   # parsed email object
+        self.parsed: email.message.Message = None   # parsed email headers
+        self.headerbytes: bytes = None  # Raw email headers
         self.ticketid: int = None       # ID of ticket
         self.tickethash: str = None     # Hashed ticket ID
         self.prefixedhash: str = None   # Hashed ticket ID with prefix
 
         self.threadstarter: bool = False  # Whether mail is threadstarter
 
-        self.textbodies: Dict[str, str] = {}    # All text bodies found in email. Key is maintype, value is content.
+        self.textbodies: Dict[str, str] = {}    # Preferred text body of email. Key is subtype, value is content.
+        self.text: str = None   # Text for issue, computed by textfrombodies on first use
+        self.attachments: List[Attachment] = []     # Spooled attachments, deleted again with cleanup
+        self.queueid: int = None    # ID in work queue, if the mail has been queued
+        self.route: str = ""    # Name of the route the mail was fetched through, empty for the default route
 
-        self.process()
+        with metrics.timed("parse"):
+            self.process()
         self.determine_ticket_ID()
 
     def process(self) -> None:
-        """Parse email and fetch body and all attachments"""
-        self.parsed = email.message_from_bytes(self.rawmailcontent, policy=email.policy.EmailPolicy())    # type: email.message.EmailMessage
+        """Parse email headers and, if available, the text body
+
+        Only the headers are kept parsed. The complete message tree is discarded as soon as the text body has been
+        extracted from it."""
+        self.headerbytes = splitheader(self.rawmailcontent)
+        self.parsed = email.message_from_bytes(self.headerbytes, policy=email.policy.EmailPolicy())    # type: email.message.EmailMessage
 
         self.subject = self.parsed["subject"]
 
@@ -42,51 +178,133 @@ class ProcessedMail():
         elif self.config.ticketAddress in self.parsed["From"]:  # Take more heuristic approach
             self.threadstarter = True
 
+        if not self.headeronly:
+            self.parse_body(email.message_from_bytes(self.rawmailcontent, policy=email.policy.EmailPolicy()))
+
         self.rawmailcontent = None  # No need to store after processing
 
-        self.get_text_bodies(self.parsed)
-        self.textfrombodies()
+    def load_body(self, rawmailcontent: bytes) -> None:
+        """Complete a mail that was fetched header-only with the full email content"""
+        self.headeronly = False
+        self.size = len(rawmailcontent)
+
+        with metrics.timed("parse"):
+            self.parse_body(email.message_from_bytes(rawmailcontent, policy=email.policy.EmailPolicy()))
+
+    def parse_body(self, message: email.message.Message) -> None:
+        """Extract text body and attachments from the complete message"""
+        self.get_text_bodies(message)
+        if self.config.maxAttachmentSize:
+            self.spool_attachments(message)
+
+    def spool_attachments(self, message: email.message.Message) -> None:
+        """Write all attachments to temporary files, so the message itself doesn't need to be kept in memory"""
+        for part in message.walk():
+            if part.is_multipart():
+                continue
+            if part.get_content_disposition() != "attachment" and (
+                    part.get_content_maintype() == "text" or part.get_filename() is None):
+                continue    # Body or inline part without name, e.g. alternative text bodies
+
+            filename = part.get_filename() or "attachment-%i" % (len(self.attachments) + 1)
+            try:
+                attachment = Attachment.spool(part, filename, self.config.maxAttachmentSize)
+            except binascii.Error as e:
+                log.warning("Attachment '%s' of mail '%s' can't be decoded and is skipped: %s", filename, self.subject, e,
+                            uid=self.uid)
+                continue
+            if attachment is None:
+                log.warning("Attachment '%s' of mail '%s' exceeds the size limit of %i bytes and is skipped", filename,
+                            self.subject, self.config.maxAttachmentSize, uid=self.uid)
+                continue
+            self.attachments.append(attachment)
+
+    def to_record(self) -> dict:
+        """Serialize the parts of a fully fetched mail that are needed for importing it into Jira"""
+        return {
+            "uid": self.uid,
+            "size": self.size,
+            "headers": base64.b64encode(self.headerbytes).decode("ascii"),
+            "text": self.textfrombodies(),
+            "attachments": [[a.filename, str(a.path), a.size, a.sha256] for a in self.attachments]
+        }
+
+    @classmethod
+    def from_record(cls, record: dict, config: MailConfig) -> "ProcessedMail":
+        """Restore a mail serialized with to_record"""
+        mail = cls(record["uid"], base64.b64decode(record["headers"]), config, headeronly=True, size=record["size"])
+        mail.headeronly = False
+        mail.text = record["text"]
+        mail.attachments = [Attachment(a[0], Path(a[1]), a[2], a[3]) for a in record["attachments"]]
+        return mail
+
+    def cleanup(self) -> None:
+        """Delete temporary files of attachments"""
+        for attachment in self.attachments:
+            attachment.delete()
+        self.attachments = []
 
     def determine_ticket_ID(self):
         """Determine ticket id either from existing subject line or from uid
 
         If the Subject line contains an ID, it is taken. If it doesn't, a new one is generated.
         """
-        hashid = hashids.Hashids(salt=self.config.idSalt, alphabet=self.config.idAlphabet, min_length=self.config.idMinLength)
+        codec = ticketid.codec_for(self.config)
 
         # See if hashid is set in headers
         if self.parsed["X-Jicket-HashID"] is not None:
             self.tickethash = self.parsed["X-Jicket-HashID"]
-            self.ticketid = hashid.decode(self.parsed["X-Jicket-HashID"])
+            self.ticketid = codec.decode(self.parsed["X-Jicket-HashID"])
         else:
-            idregex = "\\[#%s([%s]{%i,}?)\\]" % (re.escape(self.config.idPrefix), re.escape(self.config.idAlphabet), self.config.idMinLength)
-            match = re.search(idregex, self.subject)
-            if match:
-                self.tickethash = match.group(1)
-                self.ticketid = hashid.decode(self.tickethash)
+            tickethash = codec.find(self.subject)
+            if tickethash is not None:
+                self.tickethash = tickethash
+                self.ticketid = codec.decode(self.tickethash)
             else:
-                self.tickethash = hashid.encode(self.uid)
+                self.tickethash = codec.encode(self.uid)
                 self.ticketid = self.uid
 
         self.prefixedhash = self.config.idPrefix + self.tickethash
 
-    def get_text_bodies(self, startpart):
-        if startpart.is_multipart():
-            for part in startpart.get_payload():
-                if part.is_multipart():
-                    self.get_text_bodies(part)
-                elif part.get_content_maintype() == "text":
-                    if part.get_content_charset() is not None:
-                        self.textbodies[part.get_content_subtype()] = part.get_payload(decode=True).decode(part.get_content_charset())
-                    else:
-                        # If no charset is provided, assume UTF-8 as per RFC 6657
-                        self.textbodies[part.get_content_subtype()] = part.get_payload(decode=True).decode("utf-8")
-        else:
-            self.textbodies[self.parsed.get_content_subtype()] = startpart.get_payload(
-                decode=True).decode(self.parsed.get_content_charset())
+    def get_text_bodies(self, message: email.message.Message) -> None:
+        """Find the preferred text body of a message and decode it
+
+        Parts are only walked until a plain text body is found, and only the body that will be used is decoded.
+        Attachments are skipped."""
+        candidates: Dict[str, email.message.Message] = {}  # First part found for each text subtype
+        for part in message.walk():
+            if part.is_multipart() or part.get_content_maintype() != "text":
+                continue
+            if part.get_content_disposition() == "attachment":
+                continue
+            candidates.setdefault(part.get_content_subtype(), part)
+            if "plain" in candidates:
+                break
+
+        for subtype in ["plain", "html"] + list(candidates.keys()):
+            if subtype in candidates:
+                self.textbodies = {subtype: decodetextpart(candidates[subtype], self.decodelimit())}
+                return
+
+    def decodelimit(self) -> Union[int, None]:
+        """Maximum number of bytes decoded from a text body, as anything beyond is cut by textfrombodies anyway"""
+        if not self.config.maxBodyLength:
+            return None
+        return self.config.maxBodyLength * HTML_LENGTH_FACTOR
 
     def textfrombodies(self) -> str:
-        """Convert text bodies to text that can be attached to an issue"""
+        """Convert text bodies to text that can be attached to an issue
+
+        The text is only computed once and limited to MailConfig.maxBodyLength characters."""
+        if self.text is None:
+            text = self.converttextbodies()
+            if self.config.maxBodyLength and len(text) > self.config.maxBodyLength:
+                text = text[:self.config.maxBodyLength] + TRUNCATION_NOTE
+            self.text = text
+        return self.text
+
+    def converttextbodies(self) -> str:
+        """Pick the preferred text body and convert it to text"""
         type_priority = ["plain", "html", "other"]  # TODO: Make configurable
 
         for texttype in type_priority:
@@ -95,7 +313,12 @@ class ProcessedMail():
                 return self.textbodies[texttype]
             if texttype == "html" and texttype in self.textbodies:
                 """HTML text. Convert to markup with html2text and remove extra spaces"""
-                text = html2text.html2text(self.textbodies[texttype])
+                html = self.textbodies[texttype]
+                if self.config.maxBodyLength:
+                    # Markup makes up most of HTML, but anything beyond this would be truncated after conversion
+                    html = html[:self.config.maxBodyLength * HTML_LENGTH_FACTOR]
+                with metrics.timed("html2text"):
+                    text = html2text.html2text(html)
                 # Remove every second newline which is added to distinguish between paragraphs in Markdown, but makes
                 # the jira ticket hard to read.
                 return re.sub("(\n.*?)\n", "\g<1>", text)
@@ -0,0 +1,209 @@
+"""Metrics of jicket operation
+
+Counters, gauges and timing histograms are collected in a process wide registry. They can be scraped in the Prometheus
+text format from an optional HTTP endpoint, and are summarized in the log periodically."""
+
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from typing import Dict, Iterator, List, Tuple
+
+import jicket.log as log
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # Histogram buckets in seconds
+
+# Type and description of all metrics
+METRICS = {
+    "jicket_stage_duration_seconds": ("histogram", "Time spent in a processing stage"),
+    "jicket_mails_fetched_total": ("counter", "Mails fetched from IMAP, header-only or complete"),
+    "jicket_fetched_bytes_total": ("counter", "Bytes of mail content fetched from IMAP"),
+    "jicket_mails_imported_total": ("counter", "Mails imported into Jira, by result"),
+    "jicket_mails_filtered_total": ("counter", "Mails filtered by the blacklist, by where the filter was applied"),
+    "jicket_mails_moved_total": ("counter", "Mails moved to the success folder"),
+    "jicket_threadstarters_total": ("counter", "Thread starters, by whether they were sent or received"),
+    "jicket_jira_errors_total": ("counter", "Failed Jira requests, by method"),
+    "jicket_route_errors_total": ("counter", "Failed cycles of a route"),
+    "jicket_queue_depth": ("gauge", "Mails waiting to be imported into Jira"),
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Histogram():
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)   # type: List[int]   # Number of observations per bucket, not cumulative
+        self.count = 0  # type: int
+        self.sum = 0.0  # type: float
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Registry():
+    """Thread safe collection of metrics"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # type: Dict[Tuple[str, LabelKey], float]
+        self.gauges = {}    # type: Dict[Tuple[str, LabelKey], float]
+        self.histograms = {}    # type: Dict[Tuple[str, LabelKey], Histogram]
+
+    def count(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, labelkey(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels: str) -> None:
+        with self.lock:
+            self.gauges[(name, labelkey(labels))] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, labelkey(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            samples = {}    # type: Dict[str, List[str]]
+            for (name, labels), value in sorted(self.counters.items()) + sorted(self.gauges.items()):
+                samples.setdefault(name, []).append("%s%s %s" % (name, labelstring(labels), formatvalue(value)))
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                cumulative = 0
+                for bound, bucketcount in zip(BUCKETS, histogram.buckets):
+                    cumulative += bucketcount
+                    samples.setdefault(name, []).append("%s_bucket%s %i" % (
+                        name, labelstring(labels + (("le", formatvalue(bound)),)), cumulative))
+                samples[name].append("%s_bucket%s %i" % (name, labelstring(labels + (("le", "+Inf"),)),
+                                                         histogram.count))
+                samples[name].append("%s_sum%s %s" % (name, labelstring(labels), formatvalue(histogram.sum)))
+                samples[name].append("%s_count%s %i" % (name, labelstring(labels), histogram.count))
+
+        for name in sorted(samples):
+            if name in METRICS:
+                lines.append("# HELP %s %s" % (name, METRICS[name][1]))
+                lines.append("# TYPE %s %s" % (name, METRICS[name][0]))
+            lines.extend(samples[name])
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Tuple[Dict[Tuple[str, LabelKey], float], Dict[Tuple[str, LabelKey], Tuple[int, float]]]:
+        """Get the current counter values and histogram counts and sums"""
+        with self.lock:
+            return dict(self.counters), {key: (h.count, h.sum) for key, h in self.histograms.items()}
+
+
+def labelkey(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def labelstring(labels: LabelKey) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{%s}" % ",".join('%s="%s"' % (name, value) for (name, _), value in zip(labels, escaped))
+
+
+def formatvalue(value: float) -> str:
+    if value == int(value):
+        return "%i" % value
+    return repr(value)
+
+
+registry = Registry()
+
+
+def count(name: str, value: float = 1, **labels: str) -> None:
+    """Increase a counter"""
+    registry.count(name, value, **labels)
+
+
+def gauge(name: str, value: float, **labels: str) -> None:
+    """Set a gauge"""
+    registry.gauge(name, value, **labels)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Measure the time spent in the block as a processing stage
+
+    Usage: with metrics.timed("imap_fetch"): ..."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        registry.observe("jicket_stage_duration_seconds", duration, stage=stage)
+        log.debug("Stage %s took %.3fs", stage, duration, stage=stage, duration=duration)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass    # Scrapes would flood the log
+
+
+def serve(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve the metrics at http://host:port/metrics in a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("Serving metrics on http://%s:%i/metrics", host, port)
+    return server
+
+
+class SummaryLogger():
+    """Logs a summary of the metrics of the past interval"""
+    def __init__(self, interval: float):
+        self.interval = interval    # type: float   # Time between summaries in seconds
+        self.lastsummary = time.time()  # type: float
+        self.lastcounters, self.lasthistograms = registry.snapshot()
+
+    def log_if_due(self) -> None:
+        """Log a summary if the interval has passed since the last one"""
+        now = time.time()
+        if not self.interval or now - self.lastsummary < self.interval:
+            return
+        counters, histograms = registry.snapshot()
+
+        totals = {}     # type: Dict[str, float]
+        for (name, labels), value in counters.items():
+            delta = value - self.lastcounters.get((name, labels), 0)
+            if delta:
+                shortname = name[len("jicket_"):-len("_total")] if name.endswith("_total") else name
+                for label in labels:
+                    shortname += " %s=%s" % label
+                totals[shortname] = totals.get(shortname, 0) + delta
+
+        stages = []
+        for (name, labels), (histcount, histsum) in sorted(histograms.items()):
+            lastcount, lastsum = self.lasthistograms.get((name, labels), (0, 0.0))
+            if histcount > lastcount:
+                stages.append("%s: %i x %.3fs" % (dict(labels).get("stage", name), histcount - lastcount,
+                                                   (histsum - lastsum) / (histcount - lastcount)))
+
+        log.info("Metrics of the last %is: %s", now - self.lastsummary, ", ".join(
+            "%s %s" % (name, formatvalue(value)) for name, value in sorted(totals.items())) or "no activity")
+        if stages:
+            log.info("Average stage times: %s", ", ".join(stages))
+
+        self.lastsummary = now
+        self.lastcounters, self.lasthistograms = counters, histograms
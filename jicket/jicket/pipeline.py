@@ -0,0 +1,58 @@
+"""Concurrent processing of mails with ordering per ticket"""
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+
+from typing import Callable, Deque, Dict, List
+
+import jicket.log as log
+from jicket.mailprocessor import ProcessedMail
+
+
+class TicketPipeline():
+    """Processes mails with a pool of worker threads
+
+    Mails belonging to different tickets are processed concurrently. Mails belonging to the same ticket are processed
+    one after another in the order they were submitted, so comments are added to an issue in order of arrival."""
+    def __init__(self, workers: int, handler: Callable[[ProcessedMail], object]):
+        self.handler = handler  # type: Callable[[ProcessedMail], object]
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+        self.lock = threading.Lock()
+        self.queues = {}    # type: Dict[str, Deque[ProcessedMail]]   # Waiting mails of tickets being processed
+        self.futures = []   # type: List[Future]
+
+    def submit(self, mail: ProcessedMail) -> None:
+        """Queue mail for processing"""
+        with self.lock:
+            if mail.prefixedhash in self.queues:
+                # A worker is already busy with this ticket and will pick up the mail afterwards
+                self.queues[mail.prefixedhash].append(mail)
+                return
+            self.queues[mail.prefixedhash] = deque([mail])
+        self.futures.append(self.pool.submit(self._run, mail.prefixedhash))
+
+    def join(self) -> None:
+        """Wait until all submitted mails have been processed"""
+        wait(self.futures)
+        self.futures = []
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=True)
+
+    def _run(self, prefixedhash: str) -> None:
+        """Process queued mails of a ticket until none are left"""
+        while True:
+            with self.lock:
+                queue = self.queues[prefixedhash]
+                if not queue:
+                    del self.queues[prefixedhash]
+                    return
+                mail = queue.popleft()
+
+            try:
+                self.handler(mail)
+            except Exception as e:
+                # Mail stays in the inbox and is retried on the next cycle
+                log.error("Processing mail '%s' failed: %s", mail.subject, e, **log.mailcontext(mail))
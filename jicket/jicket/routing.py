@@ -0,0 +1,127 @@
+"""Routing of multiple mailboxes into Jira projects within a single jicket process
+
+A routes file lists any number of routes. Each route connects an IMAP folder to a Jira project and may override the
+mailbox, ticket ID, template and filter options given on the command line. Options that are not overridden are taken
+from the command line or environment, so options shared by all routes only need to be given once.
+
+Example::
+
+    {
+        "routes": [
+            {"name": "support", "imapuser": "support@example.com", "jiraproject": "SUP", "idprefix": "SUP-"},
+            {"name": "billing", "imapuser": "billing@example.com", "jiraproject": "BIL", "idprefix": "BIL-",
+             "threadtemplate": "/etc/jicket/billing.html", "filterconfig": "/etc/jicket/billing-filter.json"}
+        ]
+    }
+"""
+
+import json
+from pathlib import Path
+
+from typing import Dict, List, Tuple
+
+from jicket.config import MailConfig, JiraConfig
+from jicket.jiraintegration import JiraSession
+from jicket.mailfilter import MailFilter
+from jicket.mailhandling import MailImporter, MailExporter
+from jicket.workqueue import WorkQueue
+
+# Options that can be set per route, with their type. Names are those of the command line arguments.
+ROUTE_OPTIONS = {
+    "imaphost": str,
+    "imapport": int,
+    "imapuser": str,
+    "imappass": str,
+    "smtphost": str,
+    "smtpport": int,
+    "smtpuser": str,
+    "smtppass": str,
+    "jiraurl": str,
+    "jirauser": str,
+    "jirapass": str,
+    "jiratoken": str,
+    "jiraproject": str,
+    "folderinbox": str,
+    "foldersuccess": str,
+    "threadtemplate": str,
+    "ticketaddress": str,
+    "filterconfig": str,
+    "fetchbatch": int,
+    "maxbodylength": int,
+    "maxattachmentsize": int,
+    "idprefix": str,
+    "idsalt": str,
+    "idalphabet": str,
+    "idminlen": int,
+}
+
+
+class Route():
+    """A mailbox whose mails are imported into a Jira project
+
+    Importer and filter belong to the route. Jira session and exporter may be shared with other routes using the same
+    Jira or SMTP account."""
+    def __init__(self, name: str, mailconf: MailConfig, jiraconf: JiraConfig, importer: MailImporter,
+                 exporter: MailExporter, jirasession: JiraSession, mailfilter: MailFilter = None,
+                 workqueue: WorkQueue = None):
+        self.name = name    # type: str   # Empty for the default route configured on the command line
+        self.mailconf = mailconf    # type: MailConfig
+        self.jiraconf = jiraconf    # type: JiraConfig
+        self.importer = importer    # type: MailImporter
+        self.exporter = exporter    # type: MailExporter
+        self.jirasession = jirasession  # type: JiraSession
+        self.mailfilter = mailfilter    # type: MailFilter
+        self.workqueue = workqueue  # type: WorkQueue
+
+    def __str__(self) -> str:
+        return self.name or "default"
+
+
+def load_routes(path: Path) -> List[Tuple[str, Dict[str, object]]]:
+    """Load a routes file
+
+    Returns:
+        List of route names and the options they override
+    """
+    with path.open("r") as f:
+        config = json.load(f)
+
+    routes = []
+    for routeconfig in config["routes"]:
+        routeconfig = dict(routeconfig)
+        name = str(routeconfig.pop("name", ""))
+        if not name:
+            raise Exception("Every route in '%s' must have a name" % path)
+        if name in (r[0] for r in routes):
+            raise Exception("Route name '%s' is used more than once" % name)
+
+        options = {}
+        for key, value in routeconfig.items():
+            if key not in ROUTE_OPTIONS:
+                raise Exception("Option '%s' of route '%s' can't be set per route" % (key, name))
+            options[key] = ROUTE_OPTIONS[key](value)
+        routes.append((name, options))
+
+    if not routes:
+        raise Exception("No routes are configured in '%s'" % path)
+    return routes
+
+
+def check_routes(routes: List[Route]) -> None:
+    """Make sure the ticket IDs of different routes can't be confused
+
+    Ticket IDs are derived from the mail UID, which is only unique within a mailbox. Routes therefore need distinct ID
+    prefixes, and mails of the same IMAP folder must not be imported through multiple routes."""
+    prefixes = {}
+    folders = {}
+    for route in routes:
+        prefix = route.mailconf.idPrefix
+        if prefix in prefixes:
+            raise Exception("Routes '%s' and '%s' use the same ticket ID prefix '%s'" % (
+                prefixes[prefix], route, prefix))
+        prefixes[prefix] = route
+
+        folder = (route.mailconf.IMAPHost, route.mailconf.IMAPUser, route.mailconf.folderInbox)
+        if folder in folders:
+            raise Exception("Routes '%s' and '%s' read from the same IMAP folder" % (folders[folder], route))
+        folders[folder] = route
@@ -0,0 +1,132 @@
+"""Templates of thread starter mails
+
+Templates are read and checked once when they are loaded, instead of every time a thread starter is sent. Next to the
+default template, language variants can be placed which are named after it, e.g. ``threadtemplate.de.html`` for
+``threadtemplate.html``. The variant is chosen by the language of the incoming mail."""
+
+import email.policy
+import re
+from pathlib import Path
+
+from typing import Dict, List, Tuple
+
+import jicket.log as log
+from jicket.mailprocessor import ProcessedMail
+
+THREADSTART_POLICY = email.policy.EmailPolicy(max_line_length=78)   # Policy of all thread starter mails
+
+SAMPLE_FIELDS = {   # Values used to check that a template can be rendered
+    "ticketid": "ABC123",
+    "subject": "Subject"
+}
+
+
+class ThreadTemplate():
+    """A single template file"""
+    def __init__(self, path: Path):
+        self.path = path    # type: Path
+        with path.open("r") as f:
+            self.text = f.read()    # type: str
+
+        # Fail now rather than when the first thread starter is sent
+        try:
+            self.render(SAMPLE_FIELDS)
+        except (KeyError, ValueError, TypeError) as e:
+            raise Exception("Thread template '%s' is invalid: %r" % (path, e))
+
+    def render(self, fields: Dict[str, str]) -> str:
+        return self.text % fields
+
+
+class ThreadTemplates():
+    """Default template of a route together with its language variants"""
+    def __init__(self, path: Path):
+        self.path = path    # type: Path   # Path of the default template
+        self.default = None     # type: ThreadTemplate
+        self.languages = {}     # type: Dict[str, ThreadTemplate]   # Variants by lowercase language tag
+        self.loadedsignature = None     # type: Tuple   # Signature of the files when they were loaded
+
+        self.load()
+
+    def variantpaths(self) -> Dict[str, Path]:
+        """Find language variants of the default template"""
+        variants = {}
+        for path in self.path.parent.glob("%s.*%s" % (self.path.stem, self.path.suffix)):
+            language = path.name[len(self.path.stem) + 1:len(path.name) - len(self.path.suffix)]
+            if re.fullmatch("[A-Za-z]{1,8}(-[A-Za-z0-9]{1,8})*", language):
+                variants[language.lower()] = path
+        return variants
+
+    def signature(self) -> Tuple:
+        """Languages and modification times of all template files, to detect changes"""
+        variants = self.variantpaths()
+        return (self.path.stat().st_mtime,) + tuple(sorted(
+            (language, path.stat().st_mtime) for language, path in variants.items()))
+
+    def load(self) -> None:
+        """Read and check all templates, replacing the current ones only if all of them are valid"""
+        signature = self.signature()
+        default = ThreadTemplate(self.path)
+        languages = {language: ThreadTemplate(path) for language, path in self.variantpaths().items()}
+
+        self.default, self.languages = default, languages
+        self.loadedsignature = signature
+
+    def reload_if_changed(self) -> bool:
+        """Reload the templates if any of them has been modified, added or removed since they were loaded
+
+        If a modified template is invalid, the current templates are kept.
+
+        Returns:
+            Whether new templates have been loaded
+        """
+        try:
+            signature = self.signature()
+        except OSError as e:
+            log.warning("Can't access thread template, keeping current template: %s", e)
+            return False
+        if signature == self.loadedsignature:
+            return False
+
+        try:
+            self.load()
+        except Exception as e:
+            log.error("Thread template '%s' could not be loaded, keeping current template: %s", self.path, e)
+            self.loadedsignature = signature    # Don't try again until a file is modified again
+            return False
+
+        log.success("Reloaded thread template '%s'", self.path)
+        return True
+
+    def select(self, mail: ProcessedMail) -> ThreadTemplate:
+        """Choose the template in the language of a mail, falling back to the default template"""
+        for language in maillanguages(mail):
+            if language in self.languages:
+                return self.languages[language]
+            primary = language.split("-")[0]
+            if primary in self.languages:
+                return self.languages[primary]
+        return self.default
+
+    def render(self, mail: ProcessedMail) -> str:
+        return self.select(mail).render({
+            "ticketid": mail.tickethash,
+            "subject": mail.subject
+        })
+
+
+def maillanguages(mail: ProcessedMail) -> List[str]:
+    """Get the lowercase language tags of a mail in order of preference
+
+    Content-Language (RFC 3282) states the language of the mail itself. Accept-Language, which some clients add, is
+    used if it is missing."""
+    languages = []
+    for header in ("Content-Language", "Accept-Language"):
+        value = mail.parsed[header]
+        if value is None:
+            continue
+        for tag in str(value).split(","):
+            tag = tag.split(";")[0].strip().lower()
+            if tag and tag != "*":
+                languages.append(tag)
+    return languages
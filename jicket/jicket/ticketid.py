@@ -0,0 +1,54 @@
+"""Encoding of ticket IDs to hashes and detection of ticket IDs in subject lines"""
+
+import functools
+import re
+
+import hashids
+
+from typing import Tuple, Union
+from jicket.config import MailConfig
+
+CACHE_SIZE = 1024   # Number of recently encoded/decoded hashes that are kept
+
+
+class TicketIDCodec():
+    """Converts between sequential ticket IDs and their hashes
+
+    Constructing the Hashids instance and compiling the ID regex is done once per configuration, see codec_for."""
+    def __init__(self, prefix: str, salt: str, alphabet: str, minlength: int):
+        self.prefix = prefix    # type: str
+        self.hashids = hashids.Hashids(salt=salt, alphabet=alphabet, min_length=minlength)
+        self.idregex = re.compile("\\[#%s([%s]{%i,}?)\\]" % (re.escape(prefix), re.escape(alphabet), minlength))
+
+        # Replies to the same ticket usually arrive close together
+        self._encode = functools.lru_cache(maxsize=CACHE_SIZE)(self.hashids.encode)
+        self._decode = functools.lru_cache(maxsize=CACHE_SIZE)(self.hashids.decode)
+
+    def encode(self, ticketid: int) -> str:
+        """Hash a sequential ticket ID"""
+        return self._encode(ticketid)
+
+    def decode(self, tickethash: str) -> Tuple[int, ...]:
+        """Get the sequential ticket ID of a hash"""
+        return self._decode(tickethash)
+
+    def find(self, subject: str) -> Union[str, None]:
+        """Find a ticket hash in a subject line
+
+        Returns:
+            Ticket hash without prefix, or None if the subject doesn't contain a ticket ID
+        """
+        match = self.idregex.search(subject or "")
+        if match:
+            return match.group(1)
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _codec(prefix: str, salt: str, alphabet: str, minlength: int) -> TicketIDCodec:
+    return TicketIDCodec(prefix, salt, alphabet, minlength)
+
+
+def codec_for(config: MailConfig) -> TicketIDCodec:
+    """Get the codec for the ticket ID settings of a config, building it only once per distinct settings"""
+    return _codec(config.idPrefix, config.idSalt, config.idAlphabet, config.idMinLength)
@@ -0,0 +1,141 @@
+"""Durable queue of mails waiting to be imported into Jira
+
+Fetched mails are stored in the queue, so they are only downloaded once even if importing them into Jira fails or
+takes a while. Failed imports are retried with exponential backoff."""
+
+import json
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from typing import List, Set
+
+from jicket.config import MailConfig
+from jicket.mailprocessor import ProcessedMail
+
+RETRY_DELAY = 30    # Delay in seconds before the first retry of a failed import
+RETRY_DELAY_MAX = 3600  # Maximum delay in seconds between retries
+
+
+class WorkQueue():
+    """Queue of fetched mails, stored in an SQLite database
+
+    Attachments of queued mails are moved into a spool directory next to the database. Each route has its own queue
+    within the same database."""
+    def __init__(self, path: Path, config: MailConfig, route: str = ""):
+        self.path = path    # type: Path
+        self.config = config    # type: MailConfig
+        self.route = route  # type: str   # Name of the route whose mails are queued
+        self.spooldir = path.parent / (path.name + "-spool")   # type: Path
+        self.spooldir.mkdir(exist_ok=True)
+        self.failedtickets = set()  # type: Set[str]   # Tickets with a failed import since the last call of due
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS workqueue ("
+                            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                            "route TEXT NOT NULL DEFAULT '', "
+                            "uidvalidity INTEGER, "
+                            "uid INTEGER NOT NULL, "
+                            "tickethash TEXT NOT NULL, "
+                            "record TEXT NOT NULL, "
+                            "attempts INTEGER NOT NULL DEFAULT 0, "
+                            "nextattempt REAL NOT NULL DEFAULT 0, "
+                            "done INTEGER NOT NULL DEFAULT 0)")
+
+    def enqueue(self, mail: ProcessedMail, uidvalidity: int) -> None:
+        """Add a fully fetched mail to the queue"""
+        for attachment in mail.attachments:
+            target = self.spooldir / attachment.path.name
+            shutil.move(str(attachment.path), str(target))
+            attachment.path = target
+
+        with self.lock, self.db:
+            cursor = self.db.execute("INSERT INTO workqueue (route, uidvalidity, uid, tickethash, record) "
+                                     "VALUES (?, ?, ?, ?, ?)",
+                                     (self.route, uidvalidity, mail.uid, str(mail.tickethash),
+                                      json.dumps(mail.to_record())))
+        mail.queueid = cursor.lastrowid
+        mail.attachments = []   # Now owned by the queue
+
+    def queued_uids(self, uidvalidity: int) -> Set[int]:
+        """Get the UIDs of all mails in the queue, including those already imported but not yet moved"""
+        with self.lock:
+            rows = self.db.execute("SELECT uid FROM workqueue WHERE route = ? AND uidvalidity IS ?",
+                                   (self.route, uidvalidity))
+            return {row[0] for row in rows}
+
+    def due(self) -> List[ProcessedMail]:
+        """Get all mails that are due for (another) import attempt, in order of arrival
+
+        A mail is held back as long as an earlier mail of the same ticket is waiting for a retry, so the mails of a
+        ticket are always imported in order. Mails returned after a failed mail of the same ticket must be skipped,
+        see held_back."""
+        now = time.time()
+        with self.lock:
+            self.failedtickets.clear()
+            rows = self.db.execute("SELECT id, tickethash, record, nextattempt FROM workqueue "
+                                   "WHERE route = ? AND done = 0 ORDER BY id", (self.route,)).fetchall()
+
+        mails = []
+        blocked = set()
+        for queueid, tickethash, record, nextattempt in rows:
+            if tickethash in blocked:
+                continue
+            if nextattempt > now:
+                blocked.add(tickethash)
+                continue
+            mail = ProcessedMail.from_record(json.loads(record), self.config)
+            mail.queueid = queueid
+            mail.route = self.route
+            mails.append(mail)
+        return mails
+
+    def held_back(self, mail: ProcessedMail) -> bool:
+        """Whether the import of an earlier mail of the same ticket has failed since the last call of due"""
+        with self.lock:
+            return str(mail.tickethash) in self.failedtickets
+
+    def complete(self, mail: ProcessedMail) -> None:
+        """Mark mail as imported, it is only removed once it has been moved out of the inbox"""
+        with self.lock, self.db:
+            self.db.execute("UPDATE workqueue SET done = 1 WHERE id = ?", (mail.queueid,))
+        mail.cleanup()
+
+    def retry(self, mail: ProcessedMail) -> float:
+        """Schedule another import attempt for a failed mail with exponential backoff
+
+        Returns:
+            Delay until the next attempt in seconds
+        """
+        with self.lock, self.db:
+            attempts = self.db.execute("SELECT attempts FROM workqueue WHERE id = ?", (mail.queueid,)).fetchone()[0]
+            delay = min(RETRY_DELAY * 2 ** attempts, RETRY_DELAY_MAX)
+            self.db.execute("UPDATE workqueue SET attempts = attempts + 1, nextattempt = ? WHERE id = ?",
+                            (time.time() + delay, mail.queueid))
+            self.failedtickets.add(str(mail.tickethash))
+        return delay
+
+    def completed_uids(self, uidvalidity: int) -> Set[int]:
+        """Get the UIDs of all imported mails that still need to be moved out of the inbox"""
+        with self.lock:
+            rows = self.db.execute("SELECT uid FROM workqueue WHERE route = ? AND done = 1 AND uidvalidity IS ?",
+                                   (self.route, uidvalidity))
+            return {row[0] for row in rows}
+
+    def remove_completed(self, uidvalidity: int, uids: Set[int]) -> None:
+        """Remove imported mails from the queue after they have been moved out of the inbox"""
+        with self.lock, self.db:
+            self.db.executemany("DELETE FROM workqueue WHERE route = ? AND done = 1 AND uidvalidity IS ? AND uid = ?",
+                                [(self.route, uidvalidity, uid) for uid in uids])
+            # Mails of an outdated UIDVALIDITY can't be moved anymore
+            self.db.execute("DELETE FROM workqueue WHERE route = ? AND done = 1 AND uidvalidity IS NOT ?",
+                            (self.route, uidvalidity))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM workqueue WHERE route = ? AND done = 0",
+                                   (self.route,)).fetchone()[0]
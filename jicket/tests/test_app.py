@@ -0,0 +1,61 @@
+import argparse
+import imaplib
+import unittest
+from unittest import mock
+
+from jicket.app import JicketApp
+from jicket.config import JiraConfig, MailConfig
+from jicket.routing import Route
+
+
+def route(name: str) -> Route:
+    """Route without mails, connected to nothing"""
+    importer = mock.Mock(moveuids=set())
+    importer.get_mail_list.return_value = []
+    importer.fetch_many.return_value = []
+    importer.fetch_bodies.return_value = []
+    return Route(name, MailConfig(), JiraConfig(), importer, mock.Mock(), mock.Mock())
+
+
+class RunCycleTest(unittest.TestCase):
+    def app(self, routes) -> JicketApp:
+        app = JicketApp.__new__(JicketApp)
+        app.args = argparse.Namespace(routebatch=0)
+        app.queued = False
+        app.pipeline = None
+        app.ledger = None
+        app.metricssummary = mock.Mock()
+        app.routes = routes
+        app.routesbyname = {r.name: r for r in routes}
+        return app
+
+    def test_failing_route(self):
+        """A broken mailbox doesn't stop the other routes and is reconnected for the next cycle"""
+        broken, working = route("broken"), route("working")
+        broken.importer.get_mail_list.side_effect = imaplib.IMAP4.abort("socket error: EOF")
+        app = self.app([working, broken])
+
+        with mock.patch("jicket.app.log") as log:
+            app.run_cycle()
+        working.importer.get_mail_list.assert_called_once()
+        working.importer.commit_moves.assert_called_once()
+        broken.importer.login.assert_called_once()
+        log.error.assert_called_once()
+
+    def test_failing_import(self):
+        """Errors other than broken connections don't cause a reconnect"""
+        failing, working = route("failing"), route("working")
+        failing.importer.get_mail_list.return_value = [1]
+        failing.importer.fetch_many.return_value = [mock.Mock(threadstarter=False)]
+        failing.importer.fetch_bodies.side_effect = ValueError("Broken mail")
+        app = self.app([working, failing])
+
+        with mock.patch("jicket.app.log"):
+            app.run_cycle()
+        working.importer.commit_moves.assert_called_once()
+        failing.importer.commit_moves.assert_called_once()
+        failing.importer.login.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
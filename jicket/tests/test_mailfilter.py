@@ -0,0 +1,183 @@
+import json
+import re
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from jicket.mailfilter import FilterRule, MailFilter, RuleMatcher, literalpattern, searchqueries
+
+
+class Mail():
+    """Stands in for a ProcessedMail, providing the fields filters look at"""
+    def __init__(self, subject: str, sender: str = "customer@example.org"):
+        self.subject = subject
+        self.parsed = {"from": sender}
+
+
+MAILS = [
+    Mail("Invoice 2023"),
+    Mail("invoice reminder"),
+    Mail("URGENT: server down"),
+    Mail("urgent: please reply"),
+    Mail("hello hello"),
+    Mail("hello world"),
+    Mail("spam and eggs"),
+    Mail("Re: Newsletter"),
+    Mail("Newsletter", "news@shop.example.com"),
+    Mail("Question", "no-reply@example.com"),
+    Mail("Out of Office", "Mailer-Daemon@example.com"),
+    Mail(""),
+    Mail(None),
+]
+
+
+def rule(subject: str = None, address: str = None, ignorecase: bool = False) -> FilterRule:
+    config = {"description": "subject %r, address %r" % (subject, address), "ignorecase": ignorecase}
+    if subject is not None:
+        config["subjectpattern"] = subject
+    if address is not None:
+        config["addresspattern"] = address
+    return FilterRule(config)
+
+
+class RuleMatcherTest(unittest.TestCase):
+    def assertMatchesIndividually(self, rules):
+        """RuleMatcher must match exactly the rules that match when checked one by one, in the same order"""
+        matcher = RuleMatcher(rules)
+        for mail in MAILS:
+            expected = [r.description for r in rules if r.filtermail(mail)]
+            self.assertEqual([r.description for r in matcher.match(mail)], expected, "Subject %r" % mail.subject)
+        return matcher
+
+    def test_combined(self):
+        matcher = self.assertMatchesIndividually([
+            rule("invoice", ignorecase=True),
+            rule("URGENT"),
+            rule("^Re:"),
+            rule("spam|eggs"),
+            rule(address="no-?reply@"),
+            rule("Office$", "[Mm]ailer-[Dd]aemon"),
+            rule(address="@shop\\.example\\.com$"),
+        ])
+        self.assertFalse(matcher.uncombined)
+        self.assertIsNotNone(matcher.subjectregex)
+
+    def test_case_sensitivity_is_kept_per_rule(self):
+        self.assertMatchesIndividually([rule("urgent", ignorecase=True), rule("Newsletter")])
+        self.assertMatchesIndividually([rule("URGENT"), rule("newsletter", ignorecase=True)])
+
+    def test_backreferences(self):
+        rules = [rule("(\\w+) \\1"), rule("invoice", ignorecase=True), rule("(?P<word>\\w+) (?P=word)")]
+        matcher = self.assertMatchesIndividually(rules)
+        self.assertEqual(matcher.uncombined, [rules[0], rules[2]])
+
+    def test_conditional_group_references(self):
+        rules = [rule("invoice", ignorecase=True), rule("(<)?foo(?(1)>)$"), rule("(?P<re>Re: )?News(?(re)letter)")]
+        matcher = self.assertMatchesIndividually(rules)
+        self.assertEqual(matcher.uncombined, [rules[1]])
+        self.assertEqual([r.description for r in matcher.match(Mail("<foo>"))], [rules[1].description])
+
+    def test_global_inline_flags(self):
+        rules = [rule("urgent"), rule("(?i)newsletter"), rule("(?x) spam \\s and"), rule(address="(?i)MAILER")]
+        matcher = self.assertMatchesIndividually(rules)
+        self.assertEqual(matcher.uncombined, rules[1:])
+
+    def test_duplicate_group_names(self):
+        rules = [rule("(?P<food>spam)"), rule("(?P<food>eggs)"), rule(address="(?P<food>news)@")]
+        matcher = self.assertMatchesIndividually(rules)
+        self.assertIsNone(matcher.subjectregex)
+        self.assertEqual(matcher.uncombined, rules)
+
+    def test_groups_of_different_rules(self):
+        """Numbered groups of one rule must not shift those of another rule"""
+        self.assertMatchesIndividually([rule("(spam) (and)"), rule("(hello) (world)"), rule("(Re): (News)")])
+
+    def test_no_rules(self):
+        matcher = self.assertMatchesIndividually([])
+        self.assertEqual(matcher.match(MAILS[0]), [])
+
+
+class LiteralPatternTest(unittest.TestCase):
+    def test_literal(self):
+        self.assertEqual(literalpattern(re.compile("newsletter")), "newsletter")
+        self.assertEqual(literalpattern(re.compile("out of office")), "out of office")
+
+    def test_escaped_characters(self):
+        self.assertEqual(literalpattern(re.compile("no\\-reply@shop\\.example\\.com")), "no-reply@shop.example.com")
+        self.assertEqual(literalpattern(re.compile("\\[SPAM\\] \\(maybe\\)")), "[SPAM] (maybe)")
+        self.assertEqual(literalpattern(re.compile("back\\\\slash")), "back\\slash")
+
+    def test_syntax(self):
+        for pattern in ("a.b", "^Re:", "Office$", "spam|eggs", "[Ss]pam", "no-?reply", "a+", "(spam)", "x{2}",
+                        "\\d+", "\\bword", "\\s", "(?i)spam"):
+            self.assertIsNone(literalpattern(re.compile(pattern)), pattern)
+
+
+class SearchKeysTest(unittest.TestCase):
+    def test_ignorecase_only(self):
+        """IMAP SEARCH is case-insensitive, so case-sensitive rules can't be searched for"""
+        self.assertIsNone(rule("newsletter").searchkeys())
+        self.assertEqual(rule("newsletter", ignorecase=True).searchkeys(), ['SUBJECT "newsletter"'])
+
+    def test_both_fields(self):
+        self.assertEqual(rule("Out of Office", "mailer-daemon@", ignorecase=True).searchkeys(),
+                         ['FROM "mailer-daemon@"', 'SUBJECT "Out of Office"'])
+
+    def test_unsearchable(self):
+        self.assertIsNone(rule("Out of Office", "^mailer-daemon@", ignorecase=True).searchkeys())
+        self.assertIsNone(rule("Rechnung für", ignorecase=True).searchkeys())
+        self.assertIsNone(rule('say "hi"', ignorecase=True).searchkeys())
+        self.assertIsNone(rule("back\\\\slash", ignorecase=True).searchkeys())
+        self.assertIsNone(rule("", ignorecase=True).searchkeys())
+
+    def test_same_mails_as_rule(self):
+        """A search key matches a case-insensitive substring, which must match exactly the mails the rule matches"""
+        for subject in ("newsletter", "RE: [spam]", "no-reply"):
+            filterrule = rule(re.escape(subject), ignorecase=True)
+            text = filterrule.searchkeys()[0][len('SUBJECT "'):-1]
+            for mail in MAILS + [Mail("Weekly NEWSLETTER"), Mail("re: [SPAM] offer"), Mail("noreply")]:
+                self.assertEqual(text.lower() in (mail.subject or "").lower(), filterrule.filtermail(mail),
+                                 "%r on %r" % (subject, mail.subject))
+
+
+class SearchQueriesTest(unittest.TestCase):
+    def test_or_combination(self):
+        rules = [rule("invoice", ignorecase=True), rule("Office", "daemon", ignorecase=True)]
+        self.assertEqual(searchqueries(rules), ['OR SUBJECT "invoice" OR FROM "daemon" SUBJECT "Office"'])
+        self.assertEqual(searchqueries(rules[:1]), ['SUBJECT "invoice"'])
+
+    def test_batches(self):
+        rules = [rule("word%i" % i, ignorecase=True) for i in range(5)]
+        with mock.patch("jicket.mailfilter.SEARCH_KEYS_PER_QUERY", 2):
+            self.assertEqual(searchqueries(rules), ['OR SUBJECT "word0" SUBJECT "word1"',
+                                                    'OR SUBJECT "word2" SUBJECT "word3"',
+                                                    'SUBJECT "word4"'])
+
+    def test_unsearchable_rule(self):
+        self.assertIsNone(searchqueries([rule("invoice", ignorecase=True), rule("^Re:", ignorecase=True)]))
+
+    def test_no_rules(self):
+        self.assertEqual(searchqueries([]), [])
+
+    def test_whitelist_must_be_searchable(self):
+        """Mails the server filters are never fetched, so the whitelist must be applicable by the server as well"""
+        config = {"blacklist": [{"subjectpattern": "newsletter", "ignorecase": True},
+                                {"subjectpattern": "^Re:", "ignorecase": True}],
+                  "whitelist": [{"addresspattern": "boss@example\\.com", "ignorecase": True}]}
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory, "filter.json")
+            path.write_text(json.dumps(config))
+            with mock.patch("jicket.mailfilter.log"):
+                mailfilter = MailFilter(path)
+            self.assertEqual(mailfilter.blacklistqueries, ['SUBJECT "newsletter"'])
+            self.assertEqual(mailfilter.whitelistqueries, ['FROM "boss@example.com"'])
+
+            config["whitelist"].append({"addresspattern": "^vip"})
+            path.write_text(json.dumps(config))
+            mailfilter.load()
+            self.assertEqual(mailfilter.blacklistqueries, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
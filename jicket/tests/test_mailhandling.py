@@ -0,0 +1,223 @@
+import re
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from jicket.config import MailConfig
+from jicket.mailhandling import MailImporter, parse_fetch_response, sizebatches, uidset
+from jicket.templates import ThreadTemplates
+
+
+def parseuidset(uids: bytes, highest: int):
+    """Expand an IMAP sequence set into the UIDs it contains, with * standing for highest"""
+    result = set()
+    for part in uids.decode().split(","):
+        if ":" in part:
+            start, end = (highest if x == "*" else int(x) for x in part.split(":"))
+            result.update(range(min(start, end), max(start, end) + 1))
+        else:
+            result.add(highest if part == "*" else int(part))
+    return result
+
+
+def headerfields(raw: bytes, fields) -> bytes:
+    """Extract the given header fields from a raw mail, like BODY[HEADER.FIELDS (...)]"""
+    header = re.split(rb"\r?\n\r?\n", raw, 1)[0]
+    lines = re.split(rb"\r?\n(?![ \t])", header)
+    return b"".join(line + b"\r\n" for line in lines if line.split(b":")[0].strip().upper() in fields) + b"\r\n"
+
+
+class FakeIMAP():
+    """Answers SELECT, UID SEARCH and UID FETCH from a dict of raw mails by UID, with responses shaped like those of
+    imaplib"""
+    def __init__(self, mails):
+        self.mails = mails
+        self.uidnext = max(mails, default=0) + 1
+        self.commands = []
+
+    def select(self, folder):
+        self.commands.append(("select", folder))
+        return "OK", [str(len(self.mails)).encode()]
+
+    def response(self, code):
+        values = {"UIDVALIDITY": 1, "UIDNEXT": self.uidnext}
+        return code, [str(values[code]).encode() if code in values else None]
+
+    def uid(self, command, *args):
+        self.commands.append((command,) + args)
+        if command == "search":
+            return self.search(args[1])
+        if command != "fetch":
+            raise NotImplementedError(command)
+        uids, query = args
+        data = []
+        for uid in sorted(parseuidset(uids, max(self.mails)) & set(self.mails)):
+            raw = self.mails[uid]
+            if "HEADER.FIELDS" in query:
+                fields = {f.encode() for f in re.search(r"HEADER\.FIELDS \(([^)]*)\)", query).group(1).split()}
+                literal = headerfields(raw, fields)
+                prefix = "%i (UID %i RFC822.SIZE %i BODY[HEADER.FIELDS (%s)] {%i}" % (
+                    uid, uid, len(raw), " ".join(sorted(f.decode() for f in fields)), len(literal))
+            else:
+                literal = raw
+                prefix = "%i (UID %i RFC822 {%i}" % (uid, uid, len(literal))
+            data.extend([(prefix.encode(), literal), b")"])
+        return "OK", data or [None]
+
+    def search(self, criteria):
+        if criteria == "(ALL)":
+            matches = set(self.mails)
+        else:
+            # A range up to * always contains the highest UID, even if the range starts above it
+            matches = parseuidset(re.fullmatch(r"\(UID (\S+)\)", criteria).group(1).encode(), max(self.mails))
+        return "OK", [" ".join(str(uid) for uid in sorted(matches & set(self.mails))).encode()]
+
+
+def importer(mails) -> MailImporter:
+    """MailImporter working on a FakeIMAP, without logging in"""
+    config = MailConfig()
+    config.ticketAddress = "support@example.com"
+    importer = MailImporter.__new__(MailImporter)
+    importer.mailconfig = config
+    importer.IMAP = FakeIMAP(mails)
+    importer.uidvalidity = None
+    importer.uidnext = None
+    importer.pendinguids = set(mails)
+    importer.moveuids = set()
+    return importer
+
+
+def rawmail(subject: str, extraheaders: str = "") -> bytes:
+    return ("From: customer@example.org\r\nTo: support@example.com\r\nSubject: %s\r\nMessage-ID: <%s@example.org>\r\n"
+            "%sContent-Type: text/plain; charset=utf-8\r\n\r\nBody of %s\r\n" % (
+                subject, subject.replace(" ", "."), extraheaders, subject)).encode()
+
+
+class HeaderPassTest(unittest.TestCase):
+    def test_thread_template_language(self):
+        """The language of a mail must still be known after fetching header-only and then the body"""
+        with tempfile.TemporaryDirectory() as directory:
+            Path(directory, "t.html").write_text("<p>Ticket %(ticketid)s</p>")
+            Path(directory, "t.de.html").write_text("<p>Anfrage %(ticketid)s</p>")
+            templates = ThreadTemplates(Path(directory, "t.html"))
+
+            mailimporter = importer({7: rawmail("Hilfe", "Content-Language: de\r\n"),
+                                     8: rawmail("Help", "Accept-Language: fr, de;q=0.5\r\n"),
+                                     9: rawmail("Plain")})
+            mails = list(mailimporter.fetch_many([7, 8, 9], headeronly=True))
+            self.assertTrue(all(mail.headeronly for mail in mails))
+            mails = {mail.uid: mail for mail in mailimporter.fetch_bodies(mails)}
+
+            self.assertEqual(mails[7].textfrombodies().strip(), "Body of Hilfe")
+            self.assertIn("Anfrage", templates.render(mails[7]))
+            self.assertIn("Anfrage", templates.render(mails[8]))
+            self.assertIn("Ticket", templates.render(mails[9]))
+
+    def test_body_batches_limited_by_size(self):
+        """Large mails are fetched on their own, small ones together"""
+        mails = {uid: rawmail("Mail %i" % uid) for uid in range(1, 6)}
+        mails[3] += b"x" * 2000
+        mailimporter = importer(mails)
+        headers = list(mailimporter.fetch_many(sorted(mails), headeronly=True))
+        self.assertEqual(headers[2].size, len(mails[3]))
+
+        mailimporter.IMAP.commands.clear()
+        with mock.patch("jicket.mailhandling.FETCH_BATCH_BYTES", 1000):
+            fetched = list(mailimporter.fetch_bodies(headers))
+        self.assertEqual([mail.uid for mail in fetched], [1, 2, 3, 4, 5])
+        self.assertEqual([command[1] for command in mailimporter.IMAP.commands], [b"1:2", b"3", b"4:5"])
+
+
+class MailListTest(unittest.TestCase):
+    def test_only_new_uids_searched(self):
+        mailimporter = importer({1: rawmail("One"), 2: rawmail("Two")})
+        self.assertEqual(mailimporter.get_mail_list(), [1, 2])
+        self.assertIn(("search", None, "(ALL)"), mailimporter.IMAP.commands)
+
+        mailimporter.IMAP.commands.clear()
+        self.assertEqual(mailimporter.get_mail_list(), [1, 2])
+        self.assertFalse([c for c in mailimporter.IMAP.commands if c[0] == "search"], "Nothing new, no search")
+
+        mailimporter.IMAP.mails.update({3: rawmail("Three"), 4: rawmail("Four")})
+        mailimporter.IMAP.uidnext = 5
+        self.assertEqual(mailimporter.get_mail_list(), [1, 2, 3, 4])
+        self.assertIn(("search", None, "(UID 3:*)"), mailimporter.IMAP.commands)
+
+    def test_range_to_highest_uid(self):
+        """n:* contains the highest UID even if it is below n, which must not be taken for a new mail"""
+        mailimporter = importer({1: rawmail("One"), 2: rawmail("Two"), 3: rawmail("Three")})
+        mailimporter.get_mail_list()
+        mailimporter.pendinguids.difference_update([1, 2])    # Moved to the success folder
+        del mailimporter.IMAP.mails[1], mailimporter.IMAP.mails[2]
+
+        # Mail 4 arrived and has been removed again by someone else
+        mailimporter.IMAP.uidnext = 5
+        with mock.patch("jicket.mailhandling.log") as log:
+            self.assertEqual(mailimporter.get_mail_list(), [3])
+        self.assertIn(("search", None, "(UID 4:*)"), mailimporter.IMAP.commands)
+        log.info.assert_not_called()
+
+
+class UidSetTest(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(uidset([1, 2, 3, 4, 7]), b"1:4,7")
+        self.assertEqual(uidset([9, 3, 2, 3, 10, 5]), b"2:3,5,9:10")
+
+    def test_single(self):
+        self.assertEqual(uidset([42]), b"42")
+
+    def test_empty(self):
+        self.assertEqual(uidset([]), b"")
+
+
+class ParseFetchResponseTest(unittest.TestCase):
+    def test_uid_before_literal(self):
+        data = [(b"1 (UID 11 RFC822 {3}", b"abc"), b")", (b"2 (UID 12 RFC822 {3}", b"def"), b")"]
+        self.assertEqual([(uid, literal) for uid, _, literal in parse_fetch_response(data)],
+                         [(11, b"abc"), (12, b"def")])
+
+    def test_uid_after_literal(self):
+        data = [(b"1 (RFC822.SIZE 3 BODY[HEADER.FIELDS (FROM)] {3}", b"abc"), b" UID 11)",
+                (b"2 (RFC822.SIZE 3 BODY[HEADER.FIELDS (FROM)] {3}", b"def"), b" UID 12)"]
+        parsed = parse_fetch_response(data)
+        self.assertEqual([(uid, literal) for uid, _, literal in parsed], [(11, b"abc"), (12, b"def")])
+        self.assertIn(b"RFC822.SIZE 3", parsed[0][1])
+
+    def test_unsolicited_responses(self):
+        """Flag updates sent by the server in between are not mistaken for parts of a message"""
+        data = [(b"1 (UID 11 RFC822 {3}", b"abc"), b")", b"5 (FLAGS (\\Seen))",
+                (b"2 (RFC822 {3}", b"def"), b" UID 12)", b"6 (FLAGS (\\Deleted) UID 99)"]
+        self.assertEqual([(uid, literal) for uid, _, literal in parse_fetch_response(data)],
+                         [(11, b"abc"), (12, b"def")])
+
+    def test_missing_uid(self):
+        data = [(b"1 (RFC822 {3}", b"abc"), b")", (b"2 (UID 12 RFC822 {3}", b"def"), b")"]
+        with mock.patch("jicket.mailhandling.log"):
+            self.assertEqual([uid for uid, _, _ in parse_fetch_response(data)], [12])
+
+    def test_nothing_found(self):
+        self.assertEqual(parse_fetch_response([None]), [])
+
+
+class SizeBatchesTest(unittest.TestCase):
+    class Mail():
+        def __init__(self, uid, size):
+            self.uid = uid
+            self.size = size
+
+    def test_count_limit(self):
+        mails = [self.Mail(uid, 10) for uid in range(1, 6)]
+        self.assertEqual(sizebatches(mails, 2, 1000), [[1, 2], [3, 4], [5]])
+
+    def test_size_limit(self):
+        mails = [self.Mail(1, 400), self.Mail(2, 400), self.Mail(3, 400), self.Mail(4, 5000), self.Mail(5, 100)]
+        self.assertEqual(sizebatches(mails, 50, 1000), [[1, 2], [3], [4], [5]])
+
+    def test_unknown_size(self):
+        mails = [self.Mail(1, 10), self.Mail(2, None), self.Mail(3, 10)]
+        self.assertEqual(sizebatches(mails, 50, 1000), [[1], [2], [3]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import email
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from jicket.config import MailConfig
+from jicket.mailprocessor import ProcessedMail
+
+
+def rawmail(*attachments) -> bytes:
+    """Multipart mail with a text body and the given (filename, base64 payload) attachments"""
+    parts = ["--b\r\nContent-Type: text/plain; charset=utf-8\r\n\r\nHello\r\n"]
+    for filename, payload in attachments:
+        parts.append("--b\r\nContent-Type: application/octet-stream\r\nContent-Disposition: attachment; "
+                     "filename=\"%s\"\r\nContent-Transfer-Encoding: base64\r\n\r\n%s\r\n" % (filename, payload))
+    return ("From: customer@example.org\r\nTo: support@example.com\r\nSubject: Attachments\r\n"
+            "Content-Type: multipart/mixed; boundary=\"b\"\r\n\r\n%s--b--\r\n" % "".join(parts)).encode()
+
+
+class AttachmentTest(unittest.TestCase):
+    def setUp(self):
+        self.config = MailConfig()
+        self.config.ticketAddress = "support@example.com"
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        patcher = mock.patch("tempfile.tempdir", self.tempdir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stray_characters(self):
+        """Characters outside the base64 alphabet are ignored, like when decoding the payload at once"""
+        raw = rawmail(("a.bin", "QUJD!QUJD"), ("b.bin", "QUJD-_QUJD\r\nQUJD"))
+        mail = ProcessedMail(1, raw, self.config)
+        expected = [part.get_payload(decode=True) for part in email.message_from_bytes(raw).walk()
+                    if part.get_filename()]
+        self.assertEqual([a.path.read_bytes() for a in mail.attachments], expected)
+        mail.cleanup()
+
+    def test_malformed_attachment_skipped(self):
+        with mock.patch("jicket.mailprocessor.log") as log:
+            mail = ProcessedMail(1, rawmail(("good.bin", "QUJD"), ("bad.bin", "Q===QUJD"), ("last.bin", "QUJD")),
+                                 self.config)
+        self.assertEqual([a.filename for a in mail.attachments], ["good.bin", "last.bin"])
+        self.assertEqual(mail.textfrombodies().strip(), "Hello")
+        log.warning.assert_called_once()
+
+        mail.cleanup()
+        self.assertEqual(list(Path(self.tempdir.name).iterdir()), [], "No temporary files left behind")
+
+
+if __name__ == "__main__":
+    unittest.main()
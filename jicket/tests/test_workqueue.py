@@ -0,0 +1,77 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from jicket.app import JicketApp
+from jicket.config import JiraConfig, MailConfig
+from jicket.mailprocessor import ProcessedMail
+from jicket.routing import Route
+from jicket.workqueue import WorkQueue
+
+
+def rawmail(subject: str) -> bytes:
+    return ("From: customer@example.org\r\nTo: support@example.com\r\nSubject: %s\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n\r\nBody of %s\r\n" % (subject, subject)).encode()
+
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.config = MailConfig()
+        self.config.ticketAddress = "support@example.com"
+        self.config.maxAttachmentSize = 0
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.queue = WorkQueue(Path(directory.name, "state.db"), self.config)
+        self.addCleanup(self.queue.db.close)
+
+        # Mails 1 and 3 are new tickets, 2 and 4 replies to ticket 1
+        self.ticket = ProcessedMail(1, rawmail("Help"), self.config).prefixedhash
+        for uid, subject in ((1, "Help"), (2, "Re: [#%s] Help" % self.ticket), (3, "Other"),
+                             (4, "Re: [#%s] Help" % self.ticket)):
+            self.queue.enqueue(ProcessedMail(uid, rawmail(subject), self.config), 7)
+
+    def app(self) -> JicketApp:
+        """JicketApp importing the queue, without connecting anywhere"""
+        importer = mock.Mock(uidvalidity=7, moveuids=set())
+        route = Route("", self.config, JiraConfig(), importer, None, mock.Mock(), workqueue=self.queue)
+        app = JicketApp.__new__(JicketApp)
+        app.queued = True
+        app.pipeline = None
+        app.ledger = None
+        app.routesbyname = {"": route}
+        return app
+
+    def test_due_in_order(self):
+        self.assertEqual([mail.uid for mail in self.queue.due()], [1, 2, 3, 4])
+        self.assertEqual(self.queue.queued_uids(7), {1, 2, 3, 4})
+        self.assertEqual(len(self.queue), 4)
+
+    def test_held_back_while_waiting_for_retry(self):
+        mails = self.queue.due()
+        self.queue.retry(mails[1])
+        self.assertEqual([mail.uid for mail in self.queue.due()], [1, 3])
+
+    def test_ticket_order_within_drain(self):
+        """Once a mail of a ticket fails, the later mails of the ticket wait for its retry"""
+        app = self.app()
+        imported = []
+
+        def apply_mail(mail):
+            imported.append(mail.uid)
+            return mail.uid != 2
+
+        with mock.patch.object(app, "apply_mail", side_effect=apply_mail), mock.patch("jicket.app.log"):
+            app.drain_queue(app.routesbyname[""])
+            self.assertEqual(imported, [1, 2, 3])
+            self.assertEqual(self.queue.completed_uids(7), {1, 3})
+            self.assertEqual([mail.uid for mail in self.queue.due()], [])
+
+            with mock.patch("time.time", return_value=2 ** 40):
+                app.drain_queue(app.routesbyname[""])
+            self.assertEqual(imported, [1, 2, 3, 2])
+            self.assertEqual(len(self.queue), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,10 +13,11 @@ setup(
     long_description_content_type="text/markdown",
     install_requires=[
         "hashids>=1,<2",
-        "jira>=2",
+        "jira>=3.1",
         "html2text"
     ],
     scripts=[
-        "jicket/bin/jicket"
+        "jicket/bin/jicket",
+        "jicket/bin/jicket-async"
     ]
 )